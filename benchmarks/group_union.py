@@ -0,0 +1,68 @@
+"""
+Compare the time it takes to compute a lot group's polygon by folding lot
+polygons together one at a time (the old BaseLotGroup.update) with a single
+cascaded union (livinglots_lots.geometry.union_polygons).
+
+Run from the repository root with GEOS available:
+
+    python benchmarks/group_union.py
+
+"""
+import os
+import sys
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+
+from django.contrib.gis.geos import MultiPolygon, Polygon
+
+from livinglots_lots.geometry import union_polygons
+
+
+GROUP_SIZES = (10, 50, 100, 250, 500)
+
+
+def make_lot_polygons(count):
+    """Make a row of adjacent, slightly overlapping lots with jagged edges."""
+    polygons = []
+    for i in range(count):
+        x = i * 0.0001
+        ring = [(x, 0)]
+        ring += [(x + 0.000105, j * 0.00001) for j in range(20)]
+        ring += [(x, 0.0002), (x, 0)]
+        polygons.append(MultiPolygon([Polygon(ring)], srid=4326))
+    return polygons
+
+
+def fold_union(polygons):
+    union = None
+    for polygon in polygons:
+        if not union:
+            union = polygon
+        else:
+            union = union.union(polygon)
+            if not isinstance(union, MultiPolygon):
+                union = MultiPolygon([union])
+    return union
+
+
+def timed(func, polygons):
+    start = default_timer()
+    func(polygons)
+    return default_timer() - start
+
+
+if __name__ == '__main__':
+    print('%10s %12s %12s' % ('lots', 'fold (s)', 'cascaded (s)'))
+    for size in GROUP_SIZES:
+        polygons = make_lot_polygons(size)
+        print('%10d %12.4f %12.4f' % (
+            size,
+            timed(fold_union, polygons),
+            timed(union_polygons, polygons),
+        ))
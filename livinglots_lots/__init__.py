@@ -1 +1,3 @@
 __version__ = '2.0.1'
+
+default_app_config = 'livinglots_lots.apps.LotsConfig'
@@ -1,6 +1,7 @@
 from django import forms
 from django.contrib import messages
 from django.core.urlresolvers import reverse
+from django.db import transaction
 from django.utils.translation import ugettext as _
 from django.views.generic import FormView
 
@@ -63,6 +64,8 @@ class AddToGroupView(LoginRequiredMixin, PermissionRequiredMixin, FormView):
 
     def _add_to_group(self, group, lots):
         """Add lots to a group."""
-        for lot in lots:
-            lot.group = group
-            lot.save()
+        # Save lots in one transaction so the group is only updated once
+        with transaction.atomic():
+            for lot in lots:
+                lot.group = group
+                lot.save()
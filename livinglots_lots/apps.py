@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class LotsConfig(AppConfig):
+    name = 'livinglots_lots'
+
+    def ready(self):
+        from .models import connect_model_receivers
+        connect_model_receivers()
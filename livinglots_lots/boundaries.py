@@ -0,0 +1,118 @@
+"""
+Set-based maintenance of lot boundary membership.
+
+Each lot's containing boundaries are stored in LotBoundary so that lots can be
+filtered and counted by boundary with an indexed join rather than a
+point-in-polygon test. Membership is written with a single INSERT ... SELECT
+joining lot centroids to boundary geometries. Rebuilds take an advisory lock
+so that they run one at a time.
+
+The membership table is only maintained and used if
+LIVINGLOTS_LOTS_USE_BOUNDARY_INDEX is True. Once it is turned on, build the
+table with the rebuild_lot_boundaries command.
+
+"""
+from zlib import crc32
+
+from django.apps import apps
+from django.db import connection, transaction
+
+from inplace.boundaries.models import Boundary
+from livinglots import get_lot_model
+
+from .conf import get_setting
+from .responsecache import invalidate_on_commit
+
+
+# The advisory lock that rebuilds hold, so that concurrent rebuilds do not
+# insert the same memberships
+REBUILD_LOCK_ID = crc32(b'livinglots_lots.boundaries') & 0x7fffffff
+
+
+def boundary_index_enabled():
+    return get_setting('USE_BOUNDARY_INDEX', False)
+
+
+def get_lotboundary_model():
+    return apps.get_model('livinglots_lots', 'LotBoundary')
+
+
+def rebuild_boundaries(lots=None, boundaries=None):
+    """
+    Rebuild boundary membership for the given lots and boundaries, both
+    querysets. If both are None, rebuild membership for every lot.
+    """
+    lotboundary_model = get_lotboundary_model()
+    lot_model = get_lot_model()
+    qn = connection.ops.quote_name
+
+    def column(model, name):
+        return qn(model._meta.get_field(name).column)
+
+    membership_table = qn(lotboundary_model._meta.db_table)
+    membership_lot = column(lotboundary_model, 'lot')
+    membership_boundary = column(lotboundary_model, 'boundary')
+    lot_pk = qn(lot_model._meta.pk.column)
+    boundary_pk = qn(Boundary._meta.pk.column)
+
+    # Limit memberships to the given lots and boundaries, if any
+    delete_where, insert_where, params = [], [], []
+    if lots is not None:
+        lots_sql, lots_params = lots.values('pk').query.sql_with_params()
+        delete_where.append('%s IN (%s)' % (membership_lot, lots_sql))
+        insert_where.append('l.%s IN (%s)' % (lot_pk, lots_sql))
+        params += list(lots_params)
+    if boundaries is not None:
+        boundaries_sql, boundaries_params = boundaries.values('pk').query.sql_with_params()
+        delete_where.append('%s IN (%s)' % (membership_boundary, boundaries_sql))
+        insert_where.append('b.%s IN (%s)' % (boundary_pk, boundaries_sql))
+        params += list(boundaries_params)
+
+    insert_sql = ('INSERT INTO {membership_table} ({lot}, {boundary}, {layer}) '
+                  'SELECT l.{lot_pk}, b.{boundary_pk}, b.{boundary_layer} '
+                  'FROM {lot_table} l '
+                  'INNER JOIN {boundary_table} b '
+                  'ON ST_Within(l.{centroid}, b.{geometry})').format(
+        boundary=membership_boundary,
+        boundary_layer=column(Boundary, 'layer'),
+        boundary_pk=boundary_pk,
+        boundary_table=qn(Boundary._meta.db_table),
+        centroid=column(lot_model, 'centroid'),
+        geometry=column(Boundary, 'geometry'),
+        layer=column(lotboundary_model, 'layer'),
+        lot=membership_lot,
+        lot_pk=lot_pk,
+        lot_table=qn(lot_model._meta.db_table),
+        membership_table=membership_table,
+    )
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        invalidate_on_commit('boundaries')
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [REBUILD_LOCK_ID])
+        if delete_where:
+            cursor.execute('DELETE FROM %s WHERE %s' % (
+                membership_table, ' OR '.join(delete_where),
+            ), params)
+            cursor.execute('%s WHERE %s' % (
+                insert_sql, ' OR '.join(insert_where),
+            ), params)
+        else:
+            cursor.execute('DELETE FROM %s' % membership_table)
+            cursor.execute(insert_sql)
+
+
+def rebuild_all_boundaries():
+    """Rebuild boundary membership from scratch."""
+    rebuild_boundaries()
+
+
+def update_lot_boundaries(lot_pks):
+    """Rebuild boundary membership for the lots with the given pks."""
+    if lot_pks and boundary_index_enabled():
+        rebuild_boundaries(lots=get_lot_model().objects.filter(pk__in=lot_pks))
+
+
+def update_boundaries(boundary_pks):
+    """Rebuild membership of the boundaries with the given pks."""
+    if boundary_pks and boundary_index_enabled():
+        rebuild_boundaries(boundaries=Boundary.objects.filter(pk__in=boundary_pks))
@@ -0,0 +1,418 @@
+"""
+Helpers for creating lots from parcels en masse.
+
+"""
+from io import BytesIO
+import json
+import logging
+from time import time
+
+from django.contrib.gis.geos import LinearRing, MultiPolygon, Polygon
+from django.db import connection, transaction
+from django.utils import six
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+from livinglots import get_lot_model, get_lotgroup_model
+
+from .boundaries import update_lot_boundaries
+from .geometry import get_simplified_polygons, union_polygons
+from .layers import update_lot_layers
+from .responsecache import get_cell_tags, invalidate_on_commit
+
+
+logger = logging.getLogger(__name__)
+
+
+class BulkLotResult(object):
+    """The outcome of creating lots in bulk."""
+
+    def __init__(self):
+        self.created = 0
+        self.rejected = []
+        self.started = time()
+        self.finished = None
+
+    def reject(self, parcel, reason):
+        self.rejected.append((parcel.pk, reason))
+
+    def finish(self):
+        self.finished = time()
+
+    def _get_elapsed(self):
+        return (self.finished or time()) - self.started
+    elapsed = property(_get_elapsed)
+
+    def _get_lots_per_second(self):
+        try:
+            return self.created / self.elapsed
+        except ZeroDivisionError:
+            return 0
+    lots_per_second = property(_get_lots_per_second)
+
+    def __unicode__(self):
+        return u'%d lots created, %d parcels rejected in %.1fs (%.1f lots/s)' % (
+            self.created,
+            len(self.rejected),
+            self.elapsed,
+            self.lots_per_second,
+        )
+
+
+class BulkLotCreator(object):
+    """
+    Create one lot per parcel, a batch of parcels at a time.
+
+    Each batch checks parcel membership and overlaps with one query apiece,
+    resolves owners once per distinct owner name, inserts its lots with
+    batched writes and assigns them to layers together. Overlaps are checked
+    against lots that existed before the batch started.
+    """
+
+    def __init__(self, manager, batch_size=1000, allow_overlap=True,
+                 **lot_kwargs):
+        self.manager = manager
+        self.batch_size = batch_size
+        self.allow_overlap = allow_overlap
+        self.lot_kwargs = lot_kwargs
+
+    def run(self, parcels):
+        result = BulkLotResult()
+        batch = []
+        for parcel in parcels:
+            batch.append(parcel)
+            if len(batch) >= self.batch_size:
+                self.create_batch(batch, result)
+                batch = []
+        if batch:
+            self.create_batch(batch, result)
+        result.finish()
+        return result
+
+    def create_batch(self, parcels, result):
+        parcels = self.exclude_duplicate_parcels(parcels, result)
+        parcels = self.exclude_parcels_in_lots(parcels, result)
+        if not self.allow_overlap:
+            parcels = self.exclude_overlapping_parcels(parcels, result)
+        if not parcels:
+            return []
+
+        with transaction.atomic():
+            # Owners are only cached within the batch so that a rolled-back
+            # batch cannot leave unsaved owners in the cache
+            owner_cache = {}
+            lots = [get_lot_model()(**self.manager.get_lot_kwargs(
+                parcel,
+                **self.get_lot_defaults(parcel, owner_cache)
+            )) for parcel in parcels]
+            lot_pks = self.insert_lots(lots, parcels)
+            update_lot_layers(lot_pks)
+            update_lot_boundaries(lot_pks)
+            invalidate_on_commit('lots', *get_lots_cell_tags(lots))
+        result.created += len(lot_pks)
+        return lot_pks
+
+    def get_lot_defaults(self, parcel, owner_cache):
+        """Get the defaults for parcel's lot, looking up its owner once."""
+        kwargs = dict(self.lot_kwargs)
+        if parcel.owner_name:
+            kwargs['owner'] = self.manager.get_parcel_owner(parcel,
+                                                            cache=owner_cache)
+        return kwargs
+
+    def exclude_duplicate_parcels(self, parcels, result):
+        """Reject parcels that appear more than once in a batch."""
+        seen = set()
+        remaining = []
+        for parcel in parcels:
+            if parcel.pk in seen:
+                result.reject(parcel, 'duplicate parcel')
+            else:
+                seen.add(parcel.pk)
+                remaining.append(parcel)
+        return remaining
+
+    def exclude_parcels_in_lots(self, parcels, result):
+        """Reject parcels that are already part of a lot."""
+        in_lots = set(get_lot_model().objects.filter(
+            parcel__in=[parcel.pk for parcel in parcels],
+        ).values_list('parcel', flat=True))
+        remaining = []
+        for parcel in parcels:
+            if parcel.pk in in_lots:
+                result.reject(parcel, 'already part of a lot')
+            else:
+                remaining.append(parcel)
+        return remaining
+
+    def exclude_overlapping_parcels(self, parcels, result):
+        """Reject parcels that overlap existing lots."""
+        if not parcels:
+            return parcels
+        try:
+            with transaction.atomic():
+                overlapping = find_overlapping_parcels(parcels)
+        except Exception:
+            # NB: This happens (rarely) with invalid geometries, fall back on
+            # checking each parcel on its own
+            logger.exception('Could not check a batch of parcels for '
+                             'overlaps, checking them one at a time')
+            overlapping = set()
+            for parcel in parcels:
+                try:
+                    with transaction.atomic():
+                        if get_lot_model().objects.filter(polygon__overlaps=parcel.geom).exists():
+                            overlapping.add(parcel.pk)
+                except Exception:
+                    logger.exception('Could not check parcel %s for overlaps',
+                                     parcel.pk)
+
+        remaining = []
+        for parcel in parcels:
+            if parcel.pk in overlapping:
+                result.reject(parcel, 'overlaps an existing lot')
+            else:
+                remaining.append(parcel)
+        return remaining
+
+    def insert_lots(self, lots, parcels):
+        """Insert the given lots, returning their pks."""
+        lot_model = get_lot_model()
+        lot_pks = bulk_insert_lots(lots, batch_size=self.batch_size)
+        if None in lot_pks:
+            # Not every database backend sets pks on bulk_create
+            lot_pks = list(lot_model.objects.filter(
+                parcel__in=[parcel.pk for parcel in parcels],
+            ).values_list('pk', flat=True))
+        return lot_pks
+
+
+class BulkGeomLotCreator(object):
+    """
+    Create lots from the features of a GeoJSON FeatureCollection, a batch of
+    features at a time.
+
+    The collection is parsed incrementally (if ijson is installed), so only a
+    batch of lots is held in memory at once. If more than one lot is created
+    the lots are grouped, and the group's polygon is built up with one union
+    per batch.
+    """
+
+    def __init__(self, manager, batch_size=500, **lot_kwargs):
+        self.manager = manager
+        self.batch_size = batch_size
+        self.lot_kwargs = lot_kwargs
+
+    def run(self, source):
+        """
+        Create lots for the given source, a GeoJSON string or file-like
+        object. Returns the lot group, the lot if only one was created or None
+        if no lots were created.
+        """
+        self.lot_pks = []
+        self.first_lots = None
+        self.polygon = None
+
+        with transaction.atomic():
+            batch = []
+            for geom in iter_geojson_polygons(source):
+                batch.append(geom)
+                if len(batch) >= self.batch_size:
+                    self.create_batch(batch)
+                    batch = []
+            if batch:
+                self.create_batch(batch)
+
+            if len(self.lot_pks) > 1:
+                return self.create_group()
+        if self.lot_pks:
+            return self.first_lots[0]
+        return None
+
+    def create_batch(self, geoms):
+        lots = [get_lot_model()(**self.manager.get_lot_kwargs_by_geom(geom, **self.lot_kwargs))
+                for geom in geoms]
+        if can_bulk_insert_lots():
+            lot_pks = bulk_insert_lots(lots, batch_size=self.batch_size)
+            update_lot_layers(lot_pks)
+            update_lot_boundaries(lot_pks)
+        else:
+            for lot in lots:
+                lot.save()
+            lot_pks = [lot.pk for lot in lots]
+
+        self.lot_pks += lot_pks
+        invalidate_on_commit('lots', *get_lots_cell_tags(lots))
+        if self.first_lots is None:
+            self.first_lots = lots
+        self.polygon = union_polygons([self.polygon] + geoms)
+
+    def create_group(self):
+        # Only the first batch of lots is kept, so that is what the group's
+        # kwargs are based on
+        kwargs = self.manager.get_lotgroup_kwargs(self.first_lots, **self.lot_kwargs)
+        group = get_lotgroup_model()(**kwargs)
+        group.polygon = self.polygon
+        group.centroid = self.polygon.centroid
+        group.save()
+
+        lot_model = get_lot_model()
+        group_field = group.lot_set.field.name
+        for i in range(0, len(self.lot_pks), self.batch_size):
+            lot_model.objects.filter(
+                pk__in=self.lot_pks[i:i + self.batch_size],
+            ).update(**{group_field: group})
+        return group
+
+
+def can_bulk_insert_lots():
+    """Does the database set pks on objects created with bulk_create()?"""
+    return getattr(connection.features, 'can_return_ids_from_bulk_insert', False)
+
+
+def get_lots_cell_tags(lots):
+    """Get the cache tags of the grid cells the given lots are in."""
+    tags = set()
+    for lot in lots:
+        if lot.centroid:
+            tags.update(get_cell_tags(lot.centroid.extent))
+    return tags
+
+
+def bulk_insert_lots(lots, batch_size=None):
+    """
+    Insert the given lots with bulk_create(), returning their pks. The pks
+    will be None if the database cannot return them.
+    """
+    for lot in lots:
+        # bulk_create() skips save(), which usually sets these
+        lot.is_visible = lot._is_visible()
+        for field_name, polygon in get_simplified_polygons(lot.polygon).items():
+            setattr(lot, field_name, polygon)
+    get_lot_model().objects.bulk_create(lots, batch_size=batch_size)
+    return [lot.pk for lot in lots]
+
+
+def _linear_ring(coordinates):
+    return LinearRing([(float(c[0]), float(c[1])) for c in coordinates])
+
+
+def polygon_from_geojson(geometry):
+    """
+    Build a MultiPolygon from a GeoJSON geometry's coordinates, without
+    serializing it again.
+    """
+    geom_type = geometry.get('type')
+    if geom_type == 'Polygon':
+        polygons = [geometry['coordinates']]
+    elif geom_type == 'MultiPolygon':
+        polygons = geometry['coordinates']
+    else:
+        raise ValueError('Only Polygon or MultiPolygon geometries are '
+                         'permitted when creating lots')
+    return MultiPolygon([
+        Polygon(*[_linear_ring(ring) for ring in rings]) for rings in polygons
+    ], srid=4326)
+
+
+def iter_geojson_polygons(source):
+    """
+    Iterate over the geometries of the features in a GeoJSON
+    FeatureCollection as MultiPolygons. source can be a string or a file-like
+    object. If ijson is installed the collection is parsed incrementally,
+    otherwise it is loaded all at once.
+    """
+    if isinstance(source, six.text_type):
+        source = source.encode('utf-8')
+    if isinstance(source, six.binary_type):
+        source = BytesIO(source)
+
+    if ijson:
+        geometries = _iter_geometries_incrementally(source)
+    else:
+        geometries = _iter_geometries(source)
+    for geometry in geometries:
+        yield polygon_from_geojson(geometry or {})
+
+
+NOT_A_FEATURE_COLLECTION = 'GeoJSON must be a FeatureCollection with features'
+
+
+def _iter_geometries(source):
+    try:
+        collection = json.load(source)
+    except ValueError:
+        raise ValueError('Could not parse GeoJSON')
+    try:
+        features = collection['features']
+    except (KeyError, TypeError):
+        raise ValueError(NOT_A_FEATURE_COLLECTION)
+    if not isinstance(features, list):
+        raise ValueError(NOT_A_FEATURE_COLLECTION)
+    for feature in features:
+        yield feature.get('geometry') if isinstance(feature, dict) else None
+
+
+def _iter_geometries_incrementally(source):
+    """
+    Iterate over the geometries of a FeatureCollection as it is parsed. The
+    geometries are built from ijson.parse() events directly, which every
+    version of ijson supports.
+    """
+    found_features = False
+    builder = None
+    try:
+        for prefix, event, value in ijson.parse(source):
+            if builder is not None:
+                # Building a geometry, until its map or array ends
+                if prefix == 'features.item.geometry' and event in ('end_map', 'end_array'):
+                    builder.event(event, value)
+                    yield builder.value
+                    builder = None
+                else:
+                    builder.event(event, value)
+            elif prefix == 'features' and event == 'start_array':
+                found_features = True
+            elif prefix == 'features.item':
+                if event == 'start_map':
+                    has_geometry = False
+                elif event == 'end_map':
+                    if not has_geometry:
+                        yield None
+                elif event not in ('map_key', 'end_array'):
+                    # A feature that is not an object
+                    yield None
+            elif prefix == 'features.item.geometry':
+                has_geometry = True
+                if event in ('start_map', 'start_array'):
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+                else:
+                    yield value
+    except ijson.JSONError:
+        raise ValueError('Could not parse GeoJSON')
+    if not found_features:
+        raise ValueError(NOT_A_FEATURE_COLLECTION)
+
+
+def find_overlapping_parcels(parcels):
+    """Get the pks of the given parcels that overlap existing lots."""
+    qn = connection.ops.quote_name
+    lot_model = get_lot_model()
+    parcel_model = parcels[0].__class__
+    sql = ('SELECT DISTINCT p.{parcel_pk} FROM {parcel_table} p '
+           'INNER JOIN {lot_table} l ON ST_Overlaps(l.{polygon}, p.{geom}) '
+           'WHERE p.{parcel_pk} IN %s').format(
+        geom=qn(parcel_model._meta.get_field('geom').column),
+        lot_table=qn(lot_model._meta.db_table),
+        parcel_pk=qn(parcel_model._meta.pk.column),
+        parcel_table=qn(parcel_model._meta.db_table),
+        polygon=qn(lot_model._meta.get_field('polygon').column),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [tuple(parcel.pk for parcel in parcels)])
+        return set(row[0] for row in cursor.fetchall())
+
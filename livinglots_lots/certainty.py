@@ -0,0 +1,139 @@
+"""
+Scoring the known use certainty of many lots at once.
+
+Rather than calling BaseLot.calculate_known_use_certainty() on each lot, the
+features of every unlocked lot are loaded into columnar arrays and scored
+together. This requires NumPy.
+
+Deployments can score lots their own way by subclassing
+KnownUseCertaintyScorer, overriding score() and pointing
+LIVINGLOTS_LOTS_CERTAINTY_SCORER at the subclass. The default scorer keeps
+the existing certainties.
+
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import FieldError, ImproperlyConfigured
+from django.db import transaction
+from django.utils.module_loading import import_string
+from django.utils.timezone import now
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from livinglots import get_lot_model, get_lotlayer_model, get_organizer_model
+
+from .conf import get_setting
+from .responsecache import invalidate_on_commit
+
+
+class KnownUseCertaintyScorer(object):
+    """Score the known use certainty of unlocked lots in bulk."""
+
+    # Lots are written this many at a time
+    chunk_size = 5000
+
+    def __init__(self):
+        if np is None:
+            raise ImproperlyConfigured('NumPy is required to score known use '
+                                       'certainty in bulk')
+
+    def get_queryset(self):
+        return get_lot_model().objects.filter(known_use_locked=False)
+
+    def load_features(self, lots):
+        """
+        Load the features of the given lots into a dict of arrays that share
+        the same order as the 'pk' array.
+        """
+        rows = list(lots.values_list('pk', 'owner__owner_type',
+                                     'polygon_area', 'polygon_width',
+                                     'known_use_certainty'))
+        pks = np.array([row[0] for row in rows], dtype=np.int64)
+
+        def _float(value):
+            return np.nan if value is None else float(value)
+
+        features = {
+            'pk': pks,
+            'owner_type': np.array([row[1] or '' for row in rows], dtype=object),
+            'area': np.array([_float(row[2]) for row in rows], dtype=np.float64),
+            'width': np.array([_float(row[3]) for row in rows], dtype=np.float64),
+            'certainty': np.array([row[4] or 0 for row in rows], dtype=np.int64),
+            'has_organizer': np.in1d(pks, self.get_organized_lot_pks()),
+            'has_steward': np.in1d(pks, self.get_stewarded_lot_pks(lots)),
+        }
+        for layer_name, layer_pks in self.get_layer_lot_pks().items():
+            features['layer_%s' % layer_name] = np.in1d(pks, layer_pks)
+        return features
+
+    def get_layer_lot_pks(self):
+        """Get a dict of layer names to arrays of the pks of their lots."""
+        lotlayer_model = get_lotlayer_model()
+        if not lotlayer_model:
+            return {}
+        layers = {}
+        for name, lot_pk in lotlayer_model.objects.filter(lots__isnull=False).values_list('name', 'lots'):
+            layers.setdefault(name, []).append(lot_pk)
+        return dict((name, np.array(pks, dtype=np.int64))
+                    for name, pks in layers.items())
+
+    def get_organized_lot_pks(self):
+        organizer_model = get_organizer_model()
+        if not organizer_model:
+            return np.array([], dtype=np.int64)
+        return np.array(list(set(organizer_model.objects.filter(
+            content_type=ContentType.objects.get_for_model(get_lot_model()),
+        ).values_list('object_id', flat=True))), dtype=np.int64)
+
+    def get_stewarded_lot_pks(self, lots):
+        try:
+            return np.array(list(set(lots.filter(
+                steward_projects__isnull=False,
+            ).values_list('pk', flat=True))), dtype=np.int64)
+        except FieldError:
+            return np.array([], dtype=np.int64)
+
+    def score(self, features):
+        """
+        Get an array of certainties (0 to 10) in the same order as the
+        features. There are no fuzzy calculations yet, so by default the
+        existing certainties are kept.
+        """
+        return features['certainty']
+
+    def write(self, pks, scores):
+        """Write scores with one update per distinct score and chunk of lots."""
+        lot_model = get_lot_model()
+        updated = 0
+        with transaction.atomic():
+            invalidate_on_commit('lots')
+            for score in np.unique(scores).tolist():
+                score_pks = pks[scores == score].tolist()
+                for i in range(0, len(score_pks), self.chunk_size):
+                    updated += lot_model.objects.filter(
+                        pk__in=score_pks[i:i + self.chunk_size],
+                    ).exclude(known_use_certainty=score).update(
+                        known_use_certainty=score,
+                        updated=now(),
+                    )
+
+            # Visibility depends on certainty
+            lot_model.objects.update_visibility(self.get_queryset())
+        return updated
+
+    def run(self):
+        """Score every unlocked lot, returning the number of lots changed."""
+        features = self.load_features(self.get_queryset())
+        scores = np.clip(self.score(features), 0, 10)
+        return self.write(features['pk'], scores)
+
+
+def get_scorer():
+    scorer_class = get_setting('CERTAINTY_SCORER')
+    if scorer_class:
+        scorer_class = import_string(scorer_class)
+    else:
+        scorer_class = KnownUseCertaintyScorer
+    return scorer_class()
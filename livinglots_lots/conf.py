@@ -0,0 +1,6 @@
+from django.conf import settings
+
+
+def get_setting(name, default=None):
+    """Get the setting LIVINGLOTS_LOTS_<name>, falling back on default."""
+    return getattr(settings, 'LIVINGLOTS_LOTS_%s' % name, default)
@@ -0,0 +1,125 @@
+"""
+Helpers for lot filter sets.
+
+"""
+from collections import defaultdict
+
+from django.db import connection
+from django.db.models import Case, Count, F, IntegerField, Q, When
+
+from inplace.boundaries.models import Boundary
+
+from .boundaries import boundary_index_enabled, get_lotboundary_model
+
+
+def facet_counts(qs, **facets):
+    """
+    Count the lots in the given queryset matching each of the given facets
+    with a single aggregate query. Facets are Q objects keyed by name, a facet
+    of None counts every lot.
+    """
+    aggregates = {}
+    for name, q in facets.items():
+        if q is None:
+            aggregates[name] = Count('pk', distinct=True)
+        else:
+            aggregates[name] = Count(
+                Case(When(q, then=F('pk')), output_field=IntegerField()),
+                distinct=True,
+            )
+    return qs.aggregate(**aggregates)
+
+
+class FacetCountsMixin(object):
+    """
+    A mixin for lot FilterSets that counts any number of facets of the
+    filtered lots in one query.
+    """
+
+    def facet_counts(self, **facets):
+        return facet_counts(self.qs, **facets)
+
+
+def boundary_counts(qs, layer_names):
+    """
+    Count the lots in the given queryset whose centroids are within each
+    boundary of the given boundary layers with one join. Returns counts by
+    boundary label by layer name, including boundaries without lots.
+
+    If the boundary index is enabled lots are joined on their boundary
+    memberships, otherwise on a spatial test against the boundaries.
+    """
+    if not layer_names:
+        return {}
+    qn = connection.ops.quote_name
+    layer_field = Boundary._meta.get_field('layer')
+    layer_model = layer_field.remote_field.model
+    lot_model = qs.model
+    lots_sql, lots_params = qs.values('pk').query.sql_with_params()
+    if boundary_index_enabled():
+        lotboundary_model = get_lotboundary_model()
+        join = ('LEFT OUTER JOIN {membership_table} l '
+                'ON l.{membership_boundary} = b.{boundary_pk} '
+                'AND l.{lot_pk} IN ({lots_sql}) ').format(
+            boundary_pk=qn(Boundary._meta.pk.column),
+            lot_pk=qn(lotboundary_model._meta.get_field('lot').column),
+            lots_sql=lots_sql,
+            membership_boundary=qn(lotboundary_model._meta.get_field('boundary').column),
+            membership_table=qn(lotboundary_model._meta.db_table),
+        )
+        lot_pk = qn(lotboundary_model._meta.get_field('lot').column)
+    else:
+        join = ('LEFT OUTER JOIN {lot_table} l '
+                'ON ST_Within(l.{centroid}, b.{geometry}) '
+                'AND l.{lot_pk} IN ({lots_sql}) ').format(
+            centroid=qn(lot_model._meta.get_field('centroid').column),
+            geometry=qn(Boundary._meta.get_field('geometry').column),
+            lot_pk=qn(lot_model._meta.pk.column),
+            lot_table=qn(lot_model._meta.db_table),
+            lots_sql=lots_sql,
+        )
+        lot_pk = qn(lot_model._meta.pk.column)
+    sql = ('SELECT layer.{layer_name}, b.{label}, COUNT(l.{lot_pk}) '
+           'FROM {boundary_table} b '
+           'INNER JOIN {layer_table} layer ON layer.{layer_pk} = b.{layer} '
+           '{join}'
+           'WHERE layer.{layer_name} IN %s '
+           'GROUP BY layer.{layer_name}, b.{boundary_pk}, b.{label}').format(
+        boundary_pk=qn(Boundary._meta.pk.column),
+        boundary_table=qn(Boundary._meta.db_table),
+        join=join,
+        label=qn(Boundary._meta.get_field('label').column),
+        layer=qn(layer_field.column),
+        layer_name=qn(layer_model._meta.get_field('name').column),
+        layer_pk=qn(layer_model._meta.pk.column),
+        layer_table=qn(layer_model._meta.db_table),
+        lot_pk=lot_pk,
+    )
+    counts = defaultdict(dict)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, list(lots_params) + [tuple(layer_names)])
+        for layer_name, label, count in cursor.fetchall():
+            counts[layer_name][label] = count
+    return dict(counts)
+
+
+def filter_boundaries(qs, layer_name, labels):
+    """
+    Filter the given lots to those within any of the boundaries with the
+    given labels in the boundary layer with the given name.
+    """
+    if not labels:
+        return qs
+    boundaries = Boundary.objects.filter(layer__name=layer_name,
+                                         label__in=labels)
+    if boundary_index_enabled():
+        return qs.filter(pk__in=get_lotboundary_model().objects.filter(
+            boundary__in=boundaries,
+        ).values('lot'))
+
+    within = Q()
+    for boundary in boundaries:
+        within |= Q(centroid__within=boundary.geometry)
+    if not within:
+        return qs.none()
+    return qs.filter(within)
@@ -0,0 +1,170 @@
+"""
+Geometry helpers for lots and lot groups.
+
+"""
+from math import cos, radians
+
+from django.contrib.gis.geos import MultiPolygon, Polygon
+
+
+def as_multipolygon(geom):
+    """Get the given geometry as a MultiPolygon, dropping non-polygons."""
+    if not geom:
+        return None
+    if geom.geom_type == 'MultiPolygon':
+        return geom
+    if geom.geom_type == 'Polygon':
+        return MultiPolygon([geom], srid=geom.srid)
+    polygons = [g for g in geom if g.geom_type == 'Polygon']
+    if not polygons:
+        return None
+    return MultiPolygon(polygons, srid=geom.srid)
+
+
+def union_polygons(geoms):
+    """
+    Union the given Polygons and MultiPolygons in one cascaded union rather
+    than folding them together one at a time. Returns a MultiPolygon or None.
+    """
+    polygons = []
+    for geom in geoms:
+        if not geom:
+            continue
+        if geom.geom_type == 'MultiPolygon':
+            polygons.extend(geom)
+        else:
+            polygons.append(geom)
+    if not polygons:
+        return None
+    collection = MultiPolygon(polygons, srid=polygons[0].srid)
+    try:
+        union = collection.unary_union
+    except AttributeError:
+        # GEOSGeometry.unary_union is not available before Django 1.10
+        union = collection.cascaded_union
+    return as_multipolygon(union)
+
+
+def _union_pair(a, b):
+    if not a:
+        return b
+    if not b:
+        return a
+    return as_multipolygon(a.union(b))
+
+
+class UnionTree(object):
+    """
+    A balanced binary tree of partial unions over keyed polygons.
+
+    The root holds the union of every polygon. Adding or removing a polygon
+    only recomputes the unions on the path from its leaf to the root, so
+    removing one of n polygons costs about log(n) unions rather than n.
+    """
+
+    def __init__(self, items, stamps=None):
+        self.build(list(items))
+        self.stamps = stamps or {}
+
+    def build(self, items):
+        self.size = 1
+        while self.size < len(items):
+            self.size *= 2
+        self.leaf_keys = [None] * self.size
+        self.nodes = [None] * (2 * self.size)
+        self.index = {}
+        for i, (key, geom) in enumerate(items):
+            self.leaf_keys[i] = key
+            self.nodes[self.size + i] = geom
+            self.index[key] = i
+        for i in range(self.size - 1, 0, -1):
+            self.nodes[i] = _union_pair(self.nodes[2 * i], self.nodes[2 * i + 1])
+
+    def _get_union(self):
+        return self.nodes[1]
+    union = property(_get_union)
+
+    def keys(self):
+        return self.index.keys()
+
+    def items(self):
+        return [(key, self.nodes[self.size + i]) for key, i in self.index.items()]
+
+    def _update_path(self, i):
+        node = (self.size + i) // 2
+        while node:
+            self.nodes[node] = _union_pair(self.nodes[2 * node],
+                                           self.nodes[2 * node + 1])
+            node //= 2
+
+    def add(self, key, geom):
+        if key in self.index:
+            self.remove(key)
+        try:
+            i = self.leaf_keys.index(None)
+        except ValueError:
+            # Tree is full, rebuild with room for the new polygon
+            return self.build(self.items() + [(key, geom)])
+        self.leaf_keys[i] = key
+        self.nodes[self.size + i] = geom
+        self.index[key] = i
+        self._update_path(i)
+
+    def remove(self, key):
+        i = self.index.pop(key)
+        self.leaf_keys[i] = None
+        self.nodes[self.size + i] = None
+        self._update_path(i)
+
+
+# Simplified versions of lot polygons that are kept alongside the full
+# polygon: (field name, the highest zoom it is used at, tolerance in degrees,
+# GeoJSON precision). Tolerances are around a pixel at the given zoom.
+SIMPLIFIED_POLYGON_LEVELS = (
+    ('polygon_simplified_low', 13, 0.0001, 5),
+    ('polygon_simplified_medium', 16, 0.00002, 6),
+)
+
+
+def simplify_polygon(geom, tolerance):
+    """Simplify the given geometry without changing its topology."""
+    if not geom:
+        return None
+    return as_multipolygon(geom.simplify(tolerance, preserve_topology=True))
+
+
+def get_simplified_polygons(geom):
+    """Get a dict of simplified polygon field names to simplified geom."""
+    return dict((field_name, simplify_polygon(geom, tolerance))
+                for (field_name, zoom, tolerance, precision)
+                in SIMPLIFIED_POLYGON_LEVELS)
+
+
+def get_polygon_level(zoom):
+    """
+    Get the (field name, precision) of the polygon to use at the given zoom,
+    falling back on the full polygon.
+    """
+    try:
+        zoom = int(zoom)
+    except (TypeError, ValueError):
+        return ('polygon', 8)
+    for (field_name, max_zoom, tolerance, precision) in SIMPLIFIED_POLYGON_LEVELS:
+        if zoom <= max_zoom:
+            return (field_name, precision)
+    return ('polygon', 8)
+
+
+def get_envelope(point, miles):
+    """
+    Get a rectangle in WGS84 that contains every point within the given
+    distance of the given point, for bounding box index lookups.
+    """
+    lat_degrees = miles / 69.0
+    lng_degrees = lat_degrees / max(cos(radians(point.y)), .01)
+    return Polygon.from_bbox((
+        point.x - lng_degrees,
+        point.y - lat_degrees,
+        point.x + lng_degrees,
+        point.y + lat_degrees,
+    ))
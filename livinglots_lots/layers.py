@@ -0,0 +1,112 @@
+"""
+Set-based maintenance of lot layer membership.
+
+Rather than checking each lot against each layer, every layer's members are
+written with a single INSERT ... SELECT built from the layer's filter.
+
+"""
+import logging
+
+from django.db import connection, transaction
+from django.utils.timezone import now
+
+from livinglots import get_lot_model, get_lotlayer_model
+
+from .responsecache import invalidate_on_commit
+
+
+logger = logging.getLogger(__name__)
+
+
+def _get_layers(lotlayer_model, layer_names):
+    """Get the layers with the given names, creating any that are missing."""
+    layers = dict((layer.name, layer) for layer in
+                  lotlayer_model.objects.filter(name__in=layer_names))
+    for name in layer_names:
+        if name not in layers:
+            layers[name] = lotlayer_model.objects.create(name=name)
+    return layers
+
+
+def rebuild_layers(lots=None):
+    """
+    Rebuild layer membership for the given lots, a queryset. If lots is None,
+    rebuild membership for every lot.
+    """
+    lotlayer_model = get_lotlayer_model()
+    if not lotlayer_model:
+        return
+    lot_model = get_lot_model()
+    qn = connection.ops.quote_name
+
+    lots_field = lotlayer_model._meta.get_field('lots')
+    through = lots_field.remote_field.through
+    through_table = qn(through._meta.db_table)
+    layer_column = qn(through._meta.get_field(lots_field.m2m_field_name()).column)
+    lot_column = qn(through._meta.get_field(lots_field.m2m_reverse_field_name()).column)
+    pk_column = qn(lot_model._meta.pk.column)
+
+    layer_filters = lotlayer_model.get_layer_filters()
+    layers = _get_layers(lotlayer_model, layer_filters.keys())
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        invalidate_on_commit('layers')
+
+        # Clear the lots' layers
+        if lots is None:
+            cursor.execute('DELETE FROM %s' % through_table)
+        else:
+            lots_sql, lots_params = lots.values('pk').query.sql_with_params()
+            cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                through_table, lot_column, lots_sql,
+            ), lots_params)
+
+        # Add lots to each layer they should be part of
+        for layer_name, layer_filter in layer_filters.items():
+            members = lot_model.objects.filter(layer_filter)
+            if lots is not None:
+                members = members.filter(pk__in=lots.values('pk'))
+            try:
+                with transaction.atomic():
+                    members_sql, members_params = members.values('pk').distinct().query.sql_with_params()
+                    cursor.execute(
+                        'INSERT INTO %s (%s, %s) SELECT %%s, members.%s FROM (%s) members' % (
+                            through_table, layer_column, lot_column, pk_column,
+                            members_sql,
+                        ),
+                        [layers[layer_name].pk] + list(members_params)
+                    )
+            except Exception:
+                # NB: Layer filters may not apply to every lot model. The
+                # layer is left empty, so say so.
+                logger.exception('Could not rebuild lot layer %s', layer_name)
+
+
+def rebuild_all_layers():
+    """Rebuild every layer from scratch."""
+    started = now()
+    rebuild_layers()
+    get_lotlayer_model().objects.update(rebuilt=started)
+
+
+def update_layers(since=None):
+    """
+    Rebuild layer membership for lots updated since the given datetime. If no
+    datetime is given, use the time of the least recent rebuild, falling back
+    on a full rebuild if any layer has never been rebuilt.
+    """
+    lotlayer_model = get_lotlayer_model()
+    if since is None:
+        rebuilt = list(lotlayer_model.objects.values_list('rebuilt', flat=True))
+        if not rebuilt or None in rebuilt:
+            return rebuild_all_layers()
+        since = min(rebuilt)
+    started = now()
+    rebuild_layers(get_lot_model().objects.filter(updated__gte=since))
+    lotlayer_model.objects.update(rebuilt=started)
+
+
+def update_lot_layers(lot_pks):
+    """Rebuild layer membership for the lots with the given pks."""
+    if lot_pks:
+        rebuild_layers(get_lot_model().objects.filter(pk__in=lot_pks))
@@ -0,0 +1,201 @@
+"""
+Deferred maintenance of lot layers, lot boundaries and lot groups.
+
+Lots, boundaries and groups that need maintenance are collected in a dirty set for the
+current transaction. When the transaction commits each of them is maintained
+once, however many times it was touched, by the configured executor. If the
+transaction is rolled back its dirty set is discarded.
+
+The executor is chosen with LIVINGLOTS_LOTS_MAINTENANCE_EXECUTOR: 'inline'
+(the default), 'thread', 'queue' or the dotted path to an executor class.
+
+"""
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.utils.module_loading import import_string
+from django.utils.six.moves import queue
+
+from livinglots import get_lotgroup_model, get_lotlayer_model
+
+from .boundaries import update_boundaries, update_lot_boundaries
+from .conf import get_setting
+from .layers import update_lot_layers
+
+
+logger = logging.getLogger(__name__)
+
+def maintain(lot_pks, group_pks, moved_lot_pks=(), boundary_pks=()):
+    """
+    Check the layers of the given lots, the boundaries of the given moved
+    lots and the members of the given boundaries, and update the given
+    groups.
+    """
+    if lot_pks and get_lotlayer_model():
+        update_lot_layers(lot_pks)
+    update_lot_boundaries(moved_lot_pks)
+    update_boundaries(boundary_pks)
+    if group_pks:
+        for group in get_lotgroup_model().objects.filter(pk__in=group_pks):
+            group.update()
+
+
+def _run(func, *args):
+    # Maintenance runs after the transaction committed, so there is nobody to
+    # raise to
+    try:
+        func(*args)
+    except Exception:
+        logger.exception('Lot maintenance failed')
+
+
+def _run_and_close_connection(func, *args):
+    try:
+        _run(func, *args)
+    finally:
+        # Worker threads get their own connections, do not leave them open
+        connection.close()
+
+
+class InlineExecutor(object):
+    """Run maintenance right away in the current thread."""
+
+    def submit(self, func, *args):
+        _run(func, *args)
+
+
+class ThreadPoolExecutor(object):
+    """Run maintenance in a pool of worker threads."""
+
+    def __init__(self, processes=None):
+        self.pool = ThreadPool(processes or get_setting('MAINTENANCE_THREADS', 2))
+
+    def submit(self, func, *args):
+        self.pool.apply_async(_run_and_close_connection, (func,) + args)
+
+
+class QueueExecutor(object):
+    """Run maintenance in order in a single background thread."""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        worker = threading.Thread(target=self.work)
+        worker.daemon = True
+        worker.start()
+
+    def submit(self, func, *args):
+        self.queue.put((func, args))
+
+    def work(self):
+        while True:
+            func, args = self.queue.get()
+            try:
+                _run_and_close_connection(func, *args)
+            finally:
+                self.queue.task_done()
+
+
+EXECUTORS = {
+    'inline': InlineExecutor,
+    'queue': QueueExecutor,
+    'thread': ThreadPoolExecutor,
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            name = get_setting('MAINTENANCE_EXECUTOR', 'inline')
+            try:
+                executor_class = EXECUTORS[name]
+            except KeyError:
+                executor_class = import_string(name)
+            _executor = executor_class()
+        return _executor
+
+
+_local = threading.local()
+
+
+def _get_dirty(using):
+    """
+    Get the dirty set that will be flushed when the current transaction on
+    using commits, or None if there is none. A dirty set whose flush is no
+    longer registered belongs to a transaction that was rolled back or has
+    already committed.
+    """
+    try:
+        dirty, callback = _local.pending[using]
+    except (AttributeError, KeyError):
+        return None
+    if any(func is callback for sids, func in connections[using].run_on_commit):
+        return dirty
+    return None
+
+
+def _mark(kind, pk, using=None):
+    if pk is None:
+        return
+    using = using or DEFAULT_DB_ALIAS
+    dirty = _get_dirty(using)
+    if dirty is not None:
+        dirty[kind].add(pk)
+        return
+
+    # Start a dirty set for this transaction and flush it when it commits.
+    # Outside a transaction it is flushed right away.
+    dirty = {
+        'boundaries': set(),
+        'groups': set(),
+        'lots': set(),
+        'moved_lots': set(),
+    }
+    dirty[kind].add(pk)
+    callback = lambda: _flush_dirty(dirty)
+    if not hasattr(_local, 'pending'):
+        _local.pending = {}
+    _local.pending[using] = (dirty, callback)
+    transaction.on_commit(callback, using=using)
+
+
+def mark_lot(pk, using=None):
+    """Check the layers of the lot with the given pk after commit."""
+    _mark('lots', pk, using=using)
+
+
+def mark_moved_lot(pk, using=None):
+    """Check the boundaries of the lot with the given pk after commit."""
+    _mark('moved_lots', pk, using=using)
+
+
+def mark_boundary(pk, using=None):
+    """Check the lots within the boundary with the given pk after commit."""
+    _mark('boundaries', pk, using=using)
+
+
+def mark_group(pk, using=None):
+    """Update the lot group with the given pk after commit."""
+    _mark('groups', pk, using=using)
+
+
+def _flush_dirty(dirty):
+    if not any(dirty.values()):
+        return
+    marked = dict((kind, sorted(pks)) for kind, pks in dirty.items())
+    for pks in dirty.values():
+        pks.clear()
+    get_executor().submit(maintain, marked['lots'], marked['groups'],
+                          marked['moved_lots'], marked['boundaries'])
+
+
+def flush(using=DEFAULT_DB_ALIAS):
+    """Maintain the lots, boundaries and groups marked so far."""
+    dirty = _get_dirty(using)
+    if dirty is not None:
+        _flush_dirty(dirty)
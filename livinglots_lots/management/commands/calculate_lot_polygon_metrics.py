@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from ...metrics import PolygonMetricsCalculator
+
+
+class Command(BaseCommand):
+    help = ('Calculate polygon_area and polygon_width for lots whose polygons '
+            'changed, or for every lot with --all.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all',
+            action='store_true',
+            default=False,
+            help='Calculate metrics for every lot with a polygon',
+        )
+        parser.add_argument('--processes',
+            default=None,
+            type=int,
+            help='The number of worker processes to use',
+        )
+
+    def handle(self, *args, **options):
+        calculator = PolygonMetricsCalculator(processes=options['processes'])
+        updated = calculator.run(incremental=not options['all'])
+        self.stdout.write('Calculated polygon metrics for %d lots' % updated)
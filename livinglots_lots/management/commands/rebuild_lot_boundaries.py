@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...boundaries import boundary_index_enabled, rebuild_all_boundaries
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the boundaries every lot is within.'
+
+    def handle(self, *args, **options):
+        if not boundary_index_enabled():
+            raise CommandError('The boundary index is not enabled, set '
+                               'LIVINGLOTS_LOTS_USE_BOUNDARY_INDEX to use it')
+        rebuild_all_boundaries()
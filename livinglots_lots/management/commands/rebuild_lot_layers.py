@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from livinglots import get_lotlayer_model
+
+from ...layers import rebuild_all_layers, update_layers
+
+
+class Command(BaseCommand):
+    help = ('Rebuild lot layers. By default every layer is rebuilt, use '
+            '--incremental to only rebuild lots updated since the last run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental',
+            action='store_true',
+            default=False,
+            help='Only rebuild lots updated since the last rebuild',
+        )
+        parser.add_argument('--since',
+            default=None,
+            help='Only rebuild lots updated since this datetime',
+        )
+
+    def handle(self, *args, **options):
+        if not get_lotlayer_model():
+            raise CommandError('No lot layer model is configured')
+        since = None
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if not since:
+                raise CommandError('Could not parse --since datetime')
+
+        if options['incremental'] or since:
+            update_layers(since=since)
+        else:
+            rebuild_all_layers()
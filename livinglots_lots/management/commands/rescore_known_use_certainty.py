@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...certainty import get_scorer
+from ...conf import get_setting
+
+
+class Command(BaseCommand):
+    help = ('Recalculate the known use certainty of every unlocked lot with '
+            'the scorer set in LIVINGLOTS_LOTS_CERTAINTY_SCORER.')
+
+    def handle(self, *args, **options):
+        if not get_setting('CERTAINTY_SCORER'):
+            raise CommandError('No scorer is configured, set '
+                               'LIVINGLOTS_LOTS_CERTAINTY_SCORER to use one')
+        updated = get_scorer().run()
+        self.stdout.write('Updated known use certainty for %d lots' % updated)
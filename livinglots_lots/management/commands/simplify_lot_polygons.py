@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from livinglots import get_lot_model
+
+
+class Command(BaseCommand):
+    help = 'Regenerate the simplified polygons of every lot.'
+
+    def handle(self, *args, **options):
+        updated = get_lot_model().objects.update_simplified_polygons()
+        self.stdout.write('Simplified polygons for %d lots' % updated)
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from livinglots import get_lot_model
+
+
+class Command(BaseCommand):
+    help = 'Recalculate is_visible for every lot.'
+
+    def handle(self, *args, **options):
+        updated = get_lot_model().objects.update_visibility()
+        self.stdout.write('Updated visibility of %d lots' % updated)
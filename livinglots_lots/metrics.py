@@ -0,0 +1,149 @@
+"""
+Calculating polygon_area and polygon_width for lots in bulk.
+
+Each polygon is projected to an equal-area projection centered on it (or to
+LIVINGLOTS_LOTS_METRICS_SRID, a projection in feet, if set) and measured in a
+pool of worker processes. Results are written with one UPDATE per batch.
+
+"""
+from decimal import Decimal
+from math import hypot
+from multiprocessing import Pool
+
+from django.contrib.gis.gdal import CoordTransform, SpatialReference
+from django.contrib.gis.geos import GEOSGeometry
+from django.db.models import Case, DecimalField, Q, Value, When
+from django.utils.timezone import now
+
+from livinglots import get_lot_model
+
+from .conf import get_setting
+from .responsecache import invalidate_on_commit
+
+
+def get_equal_area_srs(geom):
+    """Get a Lambert azimuthal equal-area projection in feet centered on geom."""
+    centroid = geom.centroid
+    return SpatialReference(
+        '+proj=laea +lat_0=%f +lon_0=%f +x_0=0 +y_0=0 +datum=WGS84 '
+        '+units=us-ft +no_defs' % (centroid.y, centroid.x)
+    )
+
+
+def minimum_rotated_rectangle_width(geom):
+    """
+    Get the width (the shorter side) of the smallest rectangle, at any
+    rotation, that contains the given geometry.
+    """
+    hull = geom.convex_hull
+    if hull.geom_type != 'Polygon':
+        return 0
+    coords = hull[0].coords
+    best_area, best_width = None, 0
+    for (x1, y1), (x2, y2) in zip(coords, coords[1:]):
+        length = hypot(x2 - x1, y2 - y1)
+        if not length:
+            continue
+
+        # The smallest rectangle has a side along one of the hull's edges
+        ux, uy = (x2 - x1) / length, (y2 - y1) / length
+        along = [x * ux + y * uy for x, y in coords]
+        across = [y * ux - x * uy for x, y in coords]
+        length_along = max(along) - min(along)
+        length_across = max(across) - min(across)
+        area = length_along * length_across
+        if best_area is None or area < best_area:
+            best_area = area
+            best_width = min(length_along, length_across)
+    return best_width
+
+
+def calculate_metrics(item):
+    """
+    Calculate (pk, area, width) for the given (pk, hexewkb, srid). Areas are
+    in square feet and widths in feet.
+    """
+    pk, hexewkb, srid = item
+    geom = GEOSGeometry(hexewkb)
+    if srid:
+        target = SpatialReference(srid)
+    else:
+        target = get_equal_area_srs(geom)
+    geom.transform(CoordTransform(geom.srs, target))
+    return (pk, geom.area, minimum_rotated_rectangle_width(geom))
+
+
+class PolygonMetricsCalculator(object):
+    """Calculate polygon_area and polygon_width for many lots."""
+
+    batch_size = 1000
+
+    def __init__(self, processes=None):
+        self.processes = processes
+        self.srid = get_setting('METRICS_SRID')
+
+    def get_queryset(self, incremental=True):
+        """
+        Get the lots to calculate metrics for. In incremental mode these are
+        the lots whose metrics are missing, which BaseLot.save() clears when
+        a lot's polygon changes.
+        """
+        lots = get_lot_model().objects.filter(polygon__isnull=False)
+        if incremental:
+            lots = lots.filter(Q(polygon_area__isnull=True) |
+                               Q(polygon_width__isnull=True))
+        return lots
+
+    def run(self, incremental=True):
+        """Calculate metrics, returning the number of lots updated."""
+        lot_model = get_lot_model()
+        pks = list(self.get_queryset(incremental=incremental).order_by('pk')
+                   .values_list('pk', flat=True))
+        pool = Pool(self.processes) if self.processes != 1 else None
+        updated = 0
+        try:
+            for i in range(0, len(pks), self.batch_size):
+                items = [
+                    (pk, polygon.hexewkb, self.srid) for pk, polygon in
+                    lot_model.objects.filter(
+                        pk__in=pks[i:i + self.batch_size],
+                    ).values_list('pk', 'polygon')
+                ]
+                if pool:
+                    results = pool.map(calculate_metrics, items)
+                else:
+                    results = map(calculate_metrics, items)
+                updated += self.write(results)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        return updated
+
+    def write(self, results):
+        """Write the given (pk, area, width) results in one update."""
+        if not results:
+            return 0
+
+        def _decimal(value):
+            return Decimal('%.2f' % value)
+
+        updated = get_lot_model().objects.filter(
+            pk__in=[pk for pk, area, width in results],
+        ).update(
+            polygon_area=Case(
+                *[When(pk=pk, then=Value(_decimal(area)))
+                  for pk, area, width in results],
+                output_field=DecimalField(max_digits=15, decimal_places=2)
+            ),
+            polygon_width=Case(
+                *[When(pk=pk, then=Value(_decimal(width)))
+                  for pk, area, width in results],
+                output_field=DecimalField(max_digits=10, decimal_places=2)
+            ),
+            updated=now(),
+        )
+        # Invalidate after writing, outside a transaction this happens right
+        # away
+        invalidate_on_commit('lots')
+        return updated
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from livinglots import get_lot_model_name
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(get_lot_model_name()),
+        ('boundaries', '__first__'),
+        ('livinglots_lots', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LotBoundary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('boundary', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='boundaries.Boundary')),
+                ('layer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='boundaries.Layer')),
+                ('lot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='boundary_memberships', to=get_lot_model_name())),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='lotboundary',
+            unique_together=set([('boundary', 'lot')]),
+        ),
+    ]
@@ -1,18 +1,32 @@
-import geojson
+from copy import copy
 
 from django.contrib.contenttypes.models import ContentType
-from django.contrib.gis.geos import GEOSGeometry, MultiPolygon
+from django.contrib.gis.db.models import GeometryField, MultiPolygonField, Union
+from django.contrib.gis.geos import GEOSGeometry
 from django.contrib.gis.measure import D
-from django.db import models
-from django.db.models import Q
+from django.core.cache import caches
+from django.core.exceptions import FieldDoesNotExist
+from django.db import DatabaseError, connection, models
+from django.db.models import F, Func, Q, Sum, Value
+from django.utils.six.moves import cPickle as pickle
+from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 
+from inplace.boundaries.models import Boundary
 from inplace.models import Place, PlaceManager
 from livinglots import (get_lot_model, get_lot_model_name, get_lotgroup_model,
                         get_lotlayer_model, get_owner_model,
                         get_owner_contact_model_name, get_owner_model_name)
 
+from . import maintenance
+from .boundaries import boundary_index_enabled
+from .bulk import BulkGeomLotCreator, BulkLotCreator
+from .conf import get_setting
 from .exceptions import ParcelAlreadyInLot
+from .geometry import (SIMPLIFIED_POLYGON_LEVELS, UnionTree, as_multipolygon,
+                       get_simplified_polygons, union_polygons)
+from .layers import update_lot_layers
+from .responsecache import get_cell_tags, invalidate_on_commit
 
 
 class BaseLotManager(PlaceManager):
@@ -31,18 +45,31 @@ class BaseLotManager(PlaceManager):
         }
         kwargs.update(**defaults)
 
-        # Create or get owner for parcels
-        if parcel.owner_name:
-            (owner, created) = get_owner_model().objects.get_or_create(
-                parcel.owner_name,
-                defaults={
-                    'owner_type': parcel.owner_type,
-                }
-            )
-            kwargs['owner'] = owner
+        # Create or get owner for parcels, unless one was already given
+        if parcel.owner_name and 'owner' not in defaults:
+            kwargs['owner'] = self.get_parcel_owner(parcel)
 
         return kwargs
 
+    def get_parcel_owner(self, parcel, cache=None):
+        """
+        Get or create the owner for the given parcel. If a cache (a dict) is
+        given, owners are looked up there by name first.
+        """
+        try:
+            return cache[parcel.owner_name]
+        except (KeyError, TypeError):
+            pass
+        (owner, created) = get_owner_model().objects.get_or_create(
+            parcel.owner_name,
+            defaults={
+                'owner_type': parcel.owner_type,
+            }
+        )
+        if cache is not None:
+            cache[parcel.owner_name] = owner
+        return owner
+
     def get_lot_kwargs_by_geom(self, geom, **defaults):
         """Get kwargs to be used to create a lot for the given geom."""
         kwargs = {
@@ -101,6 +128,18 @@ class BaseLotManager(PlaceManager):
             lot = lots[0]
         return lot
 
+    def create_lots_for_parcels_bulk(self, parcels, batch_size=1000,
+                                     allow_overlap=True, **lot_kwargs):
+        """
+        Create one lot for each of the given parcels, in batches. Parcels that
+        cannot be added are rejected rather than raising ParcelAlreadyInLot.
+
+        Returns a BulkLotResult with throughput and the rejected parcels.
+        """
+        creator = BulkLotCreator(self, batch_size=batch_size,
+                                 allow_overlap=allow_overlap, **lot_kwargs)
+        return creator.run(parcels)
+
     def create_lot_for_geom(self, geom, **lot_kwargs):
         kwargs = self.get_lot_kwargs_by_geom(geom, **lot_kwargs)
         kwargs.update(**lot_kwargs)
@@ -109,41 +148,88 @@ class BaseLotManager(PlaceManager):
         return lot
 
     def create_lot_for_geoms(self, geoms, **lot_kwargs):
-        lots = []
-        collection = geojson.loads(geoms)
-        for feature in collection['features']:
-            feature_geom = GEOSGeometry(geojson.dumps(feature['geometry']))
-            if feature_geom.geom_type not in ('Polygon', 'MultiPolygon'):
-                raise ValueError('Only Polygon or MultiPolygon geometries are '
-                                 'permitted when creating lots')
-            if feature_geom.geom_type == 'Polygon':
-                feature_geom = MultiPolygon(feature_geom)
-            lots.append(self.create_lot_for_geom(feature_geom, **lot_kwargs))
-        if len(lots) > 1:
-            kwargs = self.get_lotgroup_kwargs(lots, **lot_kwargs)
-            lot = get_lotgroup_model()(**kwargs)
-            lot.save()
-            lot.update(lots=lots)
-        else:
-            lot = lots[0]
-        return lot
+        """
+        Create lots for the features in the given GeoJSON FeatureCollection,
+        grouping them if there are more than one.
+        """
+        return self.create_lots_for_geojson(geoms, **lot_kwargs)
 
-    def get_visible(self):
+    def create_lots_for_geojson(self, source, batch_size=500, **lot_kwargs):
+        """
+        Create lots for the features in the given GeoJSON FeatureCollection, a
+        string or file-like object, parsing it incrementally and inserting
+        lots in batches.
+        """
+        creator = BulkGeomLotCreator(self, batch_size=batch_size, **lot_kwargs)
+        return creator.run(source)
+
+    def update_simplified_polygons(self, lots=None):
+        """
+        Regenerate the simplified polygons of the given lots, a queryset, or
+        of every lot if lots is None, with one UPDATE.
+        """
+        if lots is None:
+            lots = super(BaseLotManager, self).get_queryset()
+        updated = lots.update(**dict(
+            (field_name, Func(
+                Func(F('polygon'), Value(tolerance),
+                     function='ST_SimplifyPreserveTopology',
+                     output_field=MultiPolygonField()),
+                function='ST_Multi',
+                output_field=MultiPolygonField(),
+            ))
+            for (field_name, zoom, tolerance, precision)
+            in SIMPLIFIED_POLYGON_LEVELS
+        ))
+        # Invalidate after writing, outside a transaction this happens right
+        # away
+        invalidate_on_commit('lots', 'geometry')
+        return updated
+
+    def get_visible_filter(self):
         """
         Should be publicly viewable if:
             * There is no known use or its type is visible
             * The known_use_certainty is over 3
             * If any steward_projects exist, they opted in to being included
+
+        This is the rule that BaseLot._is_visible() follows. It is stored in
+        is_visible so that get_visible() does not need these joins.
         """
-        return super(BaseLotManager, self).get_queryset().filter(
-            Q(
-                Q(known_use__isnull=True) |
-                Q(known_use__visible=True, steward_inclusion_opt_in=True)
-            ),
+        return Q(
+            Q(known_use__isnull=True) |
+            Q(known_use__visible=True, steward_inclusion_opt_in=True),
             known_use_certainty__gt=3,
+        )
+
+    def get_visible(self):
+        """Get lots that are publicly viewable and not part of a group."""
+        return super(BaseLotManager, self).get_queryset().filter(
+            is_visible=True,
             group__isnull=True,
         )
 
+    def update_visibility(self, lots=None):
+        """
+        Recalculate is_visible for the given lots, a queryset, or for every
+        lot if lots is None. Only lots whose visibility changed are written.
+        """
+        if lots is None:
+            lots = super(BaseLotManager, self).get_queryset()
+        visible_filter = self.get_visible_filter()
+        updated = now()
+        shown = lots.filter(visible_filter).filter(is_visible=False).update(
+            is_visible=True,
+            updated=updated,
+        )
+        hidden = lots.exclude(visible_filter).filter(is_visible=True).update(
+            is_visible=False,
+            updated=updated,
+        )
+        if shown or hidden:
+            invalidate_on_commit('lots', 'visibility')
+        return shown + hidden
+
     def find_nearby(self, lot, include_self=False, visible_only=True, miles=.5):
         """Find lots near the given lot."""
         if visible_only:
@@ -154,6 +240,68 @@ class BaseLotManager(PlaceManager):
             qs = qs.exclude(pk=lot.pk)
         return qs.filter(centroid__distance_lte=(lot.centroid, D(mi=miles)))
 
+    def find_nearby_many(self, lots, count=5, visible_only=True, miles=.5):
+        """
+        Find the count nearest lots within the given distance of each of the
+        given lots in a single k-nearest-neighbour query.
+
+        Returns a dict of lot pks to lists of nearby lots, ordered by
+        distance. Each nearby lot has its distance set on it as distance.
+        """
+        lot_model = self.model
+        lot_pks = [lot.pk for lot in lots]
+        if not lot_pks:
+            return {}
+        qn = connection.ops.quote_name
+        conditions = ['l.{pk} <> src.{pk}', 'l.{centroid} && ST_Expand(src.{centroid}, %s)']
+        if visible_only:
+            # Matches the predicate of the partial indexes that
+            # AddVisibleLotIndexes adds
+            conditions += ['l.{is_visible}', 'l.{group} IS NULL']
+        sql = ' '.join((
+            'SELECT src.{pk}, nearby.{pk}, nearby.distance FROM {table} src',
+            'CROSS JOIN LATERAL (',
+            '    SELECT l.{pk}, ST_Distance(l.{centroid}::geography, src.{centroid}::geography) AS distance',
+            '    FROM {table} l',
+            '    WHERE ' + ' AND '.join(conditions),
+            '    ORDER BY l.{centroid} <-> src.{centroid}',
+            '    LIMIT %s',
+            ') nearby',
+            'WHERE src.{pk} IN %s AND nearby.distance <= %s',
+            'ORDER BY src.{pk}, nearby.distance',
+        )).format(
+            centroid=qn(lot_model._meta.get_field('centroid').column),
+            group=qn(lot_model._meta.get_field('group').column),
+            is_visible=qn(lot_model._meta.get_field('is_visible').column),
+            pk=qn(lot_model._meta.pk.column),
+            table=qn(lot_model._meta.db_table),
+        )
+
+        # Prefilter on a box big enough to hold the distance at any latitude
+        # up to 60 degrees
+        box_degrees = miles / 34.5
+        meters = D(mi=miles).m
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [box_degrees, count, tuple(lot_pks), meters])
+            rows = cursor.fetchall()
+
+        nearby_lots = super(BaseLotManager, self).get_queryset().in_bulk(
+            set(row[1] for row in rows)
+        )
+        nearby = dict((pk, []) for pk in lot_pks)
+        for (lot_pk, nearby_pk, distance) in rows:
+            # Copy so a lot near several lots can have several distances
+            nearby_lot = copy(nearby_lots[nearby_pk])
+            nearby_lot.distance = D(m=distance)
+            nearby[lot_pk].append(nearby_lot)
+        return nearby
+
+    def prefetch_nearby(self, lots, count=5):
+        """Load the nearby lots for each of the given lots in one query."""
+        nearby = self.find_nearby_many(lots, count=count)
+        for lot in lots:
+            lot._nearby = nearby[lot.pk]
+
 
 class VisibleLotManager(BaseLotManager):
     """A manager that only retrieves lots that are publicly viewable."""
@@ -167,6 +315,13 @@ class BaseLot(Place):
     objects = BaseLotManager()
     visible = VisibleLotManager()
 
+    # The fields whose changes can affect which layers a lot is in. If None,
+    # layers are checked every time a lot is saved.
+    layer_fields = None
+
+    # Only write fields that changed since the lot was loaded when saving
+    save_dirty_fields_only = True
+
     if get_owner_model_name():
         owner = models.ForeignKey(get_owner_model_name(),
             blank=True,
@@ -216,6 +371,7 @@ class BaseLot(Place):
 
     updated = models.DateTimeField(_('date updated'),
         auto_now=True,
+        db_index=True,
         help_text=('When this lot was last updated'),
         null=True,
     )
@@ -225,6 +381,14 @@ class BaseLot(Place):
         help_text=_('Did the steward opt in to being included on our map?'),
     )
 
+    is_visible = models.BooleanField(_('is visible'),
+        default=False,
+        db_index=True,
+        editable=False,
+        help_text=_('Is this lot publicly viewable? This is calculated when '
+                    'the lot is saved.'),
+    )
+
     polygon_area = models.DecimalField(_('polygon area'),
         max_digits=15,
         decimal_places=2,
@@ -240,6 +404,19 @@ class BaseLot(Place):
         help_text=_('The width of the polygon in feet'),
     )
 
+    polygon_simplified_low = MultiPolygonField(_('simplified polygon (low zoom)'),
+        blank=True,
+        editable=False,
+        null=True,
+        help_text=_('The polygon simplified for city-wide zoom levels'),
+    )
+    polygon_simplified_medium = MultiPolygonField(_('simplified polygon (medium zoom)'),
+        blank=True,
+        editable=False,
+        null=True,
+        help_text=_('The polygon simplified for neighborhood zoom levels'),
+    )
+
 
     class Meta:
         abstract = True
@@ -255,10 +432,159 @@ class BaseLot(Place):
         except TypeError:
             return u'%d' % self.pk
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(BaseLot, cls).from_db(db, field_names, values)
+        instance._record_loaded_values()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super(BaseLot, self).refresh_from_db(using=using, fields=fields, **kwargs)
+        # Deferred fields are loaded this way when they are first accessed
+        if fields is None or not hasattr(self, '_loaded_values'):
+            self._record_loaded_values()
+        else:
+            for field_name in fields:
+                self._record_loaded_value(field_name)
+
+    def _get_tracked_value(self, field):
+        value = getattr(self, field.attname)
+        if isinstance(field, GeometryField) and value is not None:
+            # Geometries are mutable, compare their serialized form
+            return value.ewkb
+        return value
+
+    def _record_loaded_values(self):
+        deferred = self.get_deferred_fields()
+        self._loaded_values = dict(
+            (field.attname, self._get_tracked_value(field))
+            for field in self._meta.concrete_fields
+            if field.attname not in deferred or field.attname in self.__dict__
+        )
+
+    def _record_loaded_value(self, field_name):
+        """
+        Record the given field's current value as saved, for fields that are
+        written with update() rather than save().
+        """
+        try:
+            loaded_values = self._loaded_values
+        except AttributeError:
+            return
+        field = self._meta.get_field(field_name)
+        loaded_values[field.attname] = self._get_tracked_value(field)
+
+    def get_loaded_value(self, field_name):
+        """
+        Get the value the given field had when this lot was loaded. Raises
+        KeyError if the value is not known.
+        """
+        try:
+            loaded_values = self._loaded_values
+        except AttributeError:
+            raise KeyError(field_name)
+        return loaded_values[self._meta.get_field(field_name).attname]
+
+    def get_changed_fields(self):
+        """
+        Get the attnames of the fields that changed since this lot was loaded,
+        or None if this lot was not loaded from the database.
+        """
+        try:
+            loaded_values = self._loaded_values
+        except AttributeError:
+            return None
+        # Fields that were deferred when this lot was loaded and have been
+        # set since are changed
+        return [
+            field.attname for field in self._meta.concrete_fields
+            if ((field.attname in loaded_values and
+                 self._get_tracked_value(field) != loaded_values[field.attname]) or
+                (field.attname not in loaded_values and
+                 field.attname in self.__dict__))
+        ]
+
+    def has_changed(self, field_name):
+        """Has the given field changed since this lot was loaded?"""
+        changed_fields = self.get_changed_fields()
+        if changed_fields is None:
+            return True
+        return self._meta.get_field(field_name).attname in changed_fields
+
     def save(self, *args, **kwargs):
-        super(BaseLot, self).save(*args, **kwargs)
-        if get_lotlayer_model():
-            self.check_layers()
+        self.is_visible = self._is_visible()
+        if self.has_changed('polygon'):
+            # Clear polygon metrics that were not updated along with the
+            # polygon so they will be recalculated
+            if not self.has_changed('polygon_area'):
+                self.polygon_area = None
+            if not self.has_changed('polygon_width'):
+                self.polygon_width = None
+            for field_name, polygon in get_simplified_polygons(self.polygon).items():
+                setattr(self, field_name, polygon)
+        changed_fields = self.get_changed_fields()
+        dirty_fields_only = (
+            self.save_dirty_fields_only and changed_fields is not None and
+            not self._state.adding and not args and
+            not kwargs.get('force_insert') and
+            kwargs.get('update_fields') is None
+        )
+        if dirty_fields_only:
+            kwargs['update_fields'] = changed_fields + ['updated']
+        try:
+            loaded_centroid = self.get_loaded_value('centroid')
+        except KeyError:
+            loaded_centroid = None
+        try:
+            super(BaseLot, self).save(*args, **kwargs)
+        except DatabaseError as e:
+            # Saving only the changed fields fails if the row is gone, save
+            # every field as a plain save() would
+            if not (dirty_fields_only and 'did not affect any rows' in str(e)):
+                raise
+            del kwargs['update_fields']
+            super(BaseLot, self).save(*args, **kwargs)
+
+        # Only the fields that were written are saved, others are still
+        # changed
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or not hasattr(self, '_loaded_values'):
+            self._record_loaded_values()
+        else:
+            for field_name in update_fields:
+                self._record_loaded_value(field_name)
+        invalidate_on_commit('lots', *self._get_cell_tags(loaded_centroid),
+                             using=self._state.db)
+
+        if get_lotlayer_model() and self._layers_may_have_changed(changed_fields):
+            # Check layers once the transaction commits
+            maintenance.mark_lot(self.pk, using=self._state.db)
+
+        if boundary_index_enabled() and self._centroid_may_have_moved(changed_fields):
+            # Check boundaries once the transaction commits
+            maintenance.mark_moved_lot(self.pk, using=self._state.db)
+
+    def _get_cell_tags(self, loaded_centroid=None):
+        """
+        Get the cache tags of the grid cells this lot is in, and was in when
+        loaded if its centroid has moved.
+        """
+        tags = set()
+        if self.centroid:
+            tags.update(get_cell_tags(self.centroid.extent))
+        if loaded_centroid and loaded_centroid != self._loaded_values.get('centroid'):
+            tags.update(get_cell_tags(GEOSGeometry(loaded_centroid).extent))
+        return tags
+
+    def _centroid_may_have_moved(self, changed_fields):
+        return (changed_fields is None or
+                self._meta.get_field('centroid').attname in changed_fields)
+
+    def _layers_may_have_changed(self, changed_fields):
+        if changed_fields is None or self.layer_fields is None:
+            return True
+        layer_attnames = [self._meta.get_field(f).attname for f in self.layer_fields]
+        return bool(set(changed_fields) & set(layer_attnames))
 
     @models.permalink
     def get_absolute_url(self):
@@ -267,7 +593,14 @@ class BaseLot(Place):
     def find_nearby(self, count=5):
         return self.__class__.objects.find_nearby(self).centroid() \
                 .distance(self.centroid).order_by('distance')[:count]
-    nearby = property(find_nearby)
+
+    def _get_nearby(self):
+        try:
+            return self._nearby
+        except AttributeError:
+            self._nearby = list(self.find_nearby())
+            return self._nearby
+    nearby = property(_get_nearby)
 
     def calculate_known_use_certainty(self):
         """
@@ -392,7 +725,6 @@ class BaseLot(Place):
              (self.known_use.visible and self.steward_inclusion_opt_in)) and
             self.known_use_certainty > 3
         )
-    is_visible = property(_is_visible)
 
     @models.permalink
     def get_geojson_url(self):
@@ -416,23 +748,7 @@ class BaseLot(Place):
         Add lot to each lotlayer it should be part of, remove it from the ones
         it should not be part of.
         """
-        # Clear lot's layers
-        self.lotlayer_set.clear()
-
-        # Get model classes
-        lot_model = get_lot_model()
-        lotlayer_model = get_lotlayer_model()
-
-        # Check each layer to see if the lot is part of it
-        layer_filters = lotlayer_model.get_layer_filters()
-        for layer_name in layer_filters.keys():
-            # If lot should be in layer, add it
-            try:
-                if lot_model.objects.filter(layer_filters[layer_name], pk=self.pk).exists():
-                    layer, created = lotlayer_model.objects.get_or_create(name=layer_name)
-                    self.lotlayer_set.add(layer)
-            except Exception:
-                pass
+        update_lot_layers([self.pk])
 
 
 class BaseLotLayer(models.Model):
@@ -447,6 +763,11 @@ class BaseLotLayer(models.Model):
     """
     name = models.CharField(max_length=128, unique=True)
     lots = models.ManyToManyField(get_lot_model_name())
+    rebuilt = models.DateTimeField(_('date rebuilt'),
+        blank=True,
+        null=True,
+        help_text=_('When the lots in this layer were last rebuilt'),
+    )
 
     @classmethod
     def get_layer_filters(cls):
@@ -463,20 +784,126 @@ class BaseLotLayer(models.Model):
         abstract = True
 
 
+def get_union_tree_cache():
+    """Get the cache that lot groups' union trees are kept in."""
+    return caches[get_setting('GROUP_UNION_TREE_CACHE', 'default')]
+
+
 class BaseLotGroup(models.Model):
     """A group of lots."""
 
     def add(self, lot):
-        """Add a lot to this group."""
-        lots = set(list(self.lot_set.all()))
-        lots.add(lot)
-        self.update(lots=lots)
+        """
+        Add a lot to this group, unioning only the new lot's polygon into the
+        group's polygon.
+        """
+        if self.lot_set.filter(pk=lot.pk).exists():
+            return
+        tree = self._get_cached_union_tree()
+        group_field = self.lot_set.field.name
+        lots = get_lot_model().objects.filter(pk=lot.pk)
+        lots.update(**{group_field: self})
+        invalidate_lot_responses(lots)
+        setattr(lot, group_field, self)
+        lot._record_loaded_value(group_field)
+
+        if tree:
+            tree.add(lot.pk, lot.polygon)
+            tree.stamps[lot.pk] = lot.updated
+            self._cache_union_tree(tree)
+        self.polygon = union_polygons([self.polygon, lot.polygon])
+        self._update_centroid_and_area(added=[lot])
+        self.save()
 
     def remove(self, lot):
-        """Remove a lot from this group."""
-        lots = list(self.lot_set.all())
-        lots.remove(lot)
-        self.update(lots=lots)
+        """
+        Remove a lot from this group, recomputing only the parts of the
+        group's polygon that the lot was part of.
+        """
+        tree = self._get_union_tree()
+        if lot.pk not in tree.index:
+            # As list.remove() would
+            raise ValueError('Lot %s is not in this group' % lot.pk)
+        group_field = self.lot_set.field.name
+        lots = get_lot_model().objects.filter(pk=lot.pk)
+        lots.update(**{group_field: None})
+        invalidate_lot_responses(lots)
+        setattr(lot, group_field, None)
+        lot._record_loaded_value(group_field)
+
+        tree.remove(lot.pk)
+        tree.stamps.pop(lot.pk, None)
+        self._cache_union_tree(tree)
+        self.polygon = tree.union
+        if self.polygon:
+            self._update_centroid_and_area(removed=[lot])
+        else:
+            # The group is empty
+            self.centroid = None
+            self.polygon_area = None
+            self.polygon_width = None
+        self.save()
+
+    def _get_union_tree_cache_key(self):
+        return 'livinglots_lots:lotgroup_union_tree:%s' % self.pk
+
+    def _get_cached_union_tree(self):
+        """
+        Get the cached union tree for this group if it is still current, that
+        is, if it holds the group's lots as they were last updated.
+        """
+        try:
+            tree = pickle.loads(get_union_tree_cache().get(
+                self._get_union_tree_cache_key(),
+            ))
+        except (TypeError, ValueError, EOFError, pickle.UnpicklingError):
+            tree = None
+        if tree:
+            stamps = dict(self.lot_set.values_list('pk', 'updated'))
+            if stamps == tree.stamps:
+                return tree
+        return None
+
+    def _get_union_tree(self):
+        tree = self._get_cached_union_tree()
+        if not tree:
+            lots = self.lot_set.values_list('pk', 'polygon', 'updated')
+            tree = UnionTree(
+                [(pk, polygon) for (pk, polygon, updated) in lots],
+                stamps=dict((pk, updated) for (pk, polygon, updated) in lots),
+            )
+        return tree
+
+    def _cache_union_tree(self, tree):
+        """
+        Cache the union tree, unless it is too big for the cache. Large
+        groups' trees are built again when needed.
+        """
+        key = self._get_union_tree_cache_key()
+        pickled = pickle.dumps(tree, pickle.HIGHEST_PROTOCOL)
+        if len(pickled) > get_setting('GROUP_UNION_TREE_MAX_SIZE', 900 * 1024):
+            get_union_tree_cache().delete(key)
+            return
+        get_union_tree_cache().set(key, pickled)
+
+    def _update_centroid_and_area(self, added=(), removed=()):
+        try:
+            self.centroid = self.polygon.centroid
+        except AttributeError:
+            pass
+
+        # Keep area as the sum of the lots' areas when they are all known,
+        # otherwise leave it to be recalculated
+        try:
+            area = self.polygon_area
+            for lot in added:
+                area += lot.polygon_area
+            for lot in removed:
+                area -= lot.polygon_area
+            self.polygon_area = area
+        except TypeError:
+            self.polygon_area = None
+        self.polygon_width = None
 
     def update(self, lots=None):
         """
@@ -484,32 +911,50 @@ class BaseLotGroup(models.Model):
         manually since this might be called on a lot's pre_save signal.
         """
 
-        if not lots:
+        get_union_tree_cache().delete(self._get_union_tree_cache_key())
+        if lots:
+            lots = list(lots)
+            self._update_lot_set(lots)
+            self.polygon = union_polygons([lot.polygon for lot in lots])
+            areas = [lot.polygon_area for lot in lots]
+            self.polygon_area = None if None in areas else sum(areas)
+        else:
             lots = self.lot_set.all()
-
-        # Update lot_set
-        self.lot_set.clear()
-        self.lot_set.add(*lots)
-
-        # Update polygon
-        self.polygon = None
-        for lot in lots:
-            if not lot.polygon: continue
-            if not self.polygon:
-                self.polygon = lot.polygon
-            else:
-                union = self.polygon.union(lot.polygon)
-                if not isinstance(union, MultiPolygon):
-                    union = MultiPolygon([union])
-                self.polygon = union
+            aggregates = lots.aggregate(
+                area=Sum('polygon_area'),
+                union=Union('polygon'),
+            )
+            self.polygon = as_multipolygon(aggregates['union'])
+            self.polygon_area = aggregates['area']
+        self.polygon_width = None
 
         # Update centroid
         try:
             self.centroid = self.polygon.centroid
         except AttributeError:
-            self.centroid = list(lots)[0].centroid
+            try:
+                self.centroid = lots[0].centroid
+            except IndexError:
+                self.centroid = None
         self.save()
 
+    def _update_lot_set(self, lots):
+        """Change lot_set to the given lots by adding and removing the diff."""
+        lot_pks = set(lot.pk for lot in lots)
+        current_pks = set(self.lot_set.values_list('pk', flat=True))
+        group_field = self.lot_set.field.name
+
+        lot_model = get_lot_model()
+        removed = current_pks - lot_pks
+        if removed:
+            lot_model.objects.filter(pk__in=removed).update(**{group_field: None})
+        added = lot_pks - current_pks
+        if added:
+            lot_model.objects.filter(pk__in=added).update(**{group_field: self})
+        invalidate_lot_responses(lot_model.objects.filter(
+            pk__in=lot_pks ^ current_pks,
+        ))
+
     def __unicode__(self):
         return self.name or self.address_line1 or '%s' % self.pk
 
@@ -530,6 +975,12 @@ class Use(models.Model):
                     'join, probably not.'),
     )
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Use, cls).from_db(db, field_names, values)
+        instance._loaded_visible = instance.__dict__.get('visible')
+        return instance
+
     def __unicode__(self):
         return self.name
 
@@ -537,36 +988,180 @@ class Use(models.Model):
         ordering = ('name',)
 
 
-from django.db.models.signals import post_delete, pre_save
+class LotBoundary(models.Model):
+    """
+    A boundary that a lot's centroid is within. Maintained so that lots can
+    be filtered and counted by boundary without spatial queries.
+    """
+    lot = models.ForeignKey(get_lot_model_name(),
+        on_delete=models.CASCADE,
+        related_name='boundary_memberships',
+    )
+    boundary = models.ForeignKey('boundaries.Boundary',
+        on_delete=models.CASCADE,
+        related_name='+',
+    )
+    layer = models.ForeignKey('boundaries.Layer',
+        on_delete=models.CASCADE,
+        related_name='+',
+    )
+
+    class Meta:
+        unique_together = ('boundary', 'lot',)
+
+
+from django.db.models.signals import (post_delete, post_save, pre_delete,
+                                      pre_save)
 from django.dispatch import receiver
 
 
-@receiver(pre_save, sender=BaseLot)
 def save_lot_update_group(sender, instance=None, **kwargs):
     """Update the group that this member is part of."""
     if not instance: return
 
-    # Try to get the group this instance was part of, if any
-    try:
-        previous_group = get_lot_model().objects.get(pk=instance.pk).group
-    except Exception:
-        previous_group = None
+    # Try to get the group this instance was part of, if any, preferring the
+    # value recorded when the instance was loaded
+    if instance._state.adding:
+        previous_group_pk = None
+    else:
+        try:
+            previous_group_pk = instance.get_loaded_value('group')
+        except KeyError:
+            try:
+                previous_group_pk = get_lot_model().objects.filter(
+                    pk=instance.pk,
+                ).values_list('group', flat=True)[0]
+            except IndexError:
+                previous_group_pk = None
 
     # Get the group this instance will be part of, if any
-    next_group = instance.group
+    next_group_pk = instance.group_id
 
-    # If instance was in a group before but no longer will be, update that
-    # group accordingly
-    if previous_group and previous_group != next_group:
-        previous_group.remove(instance)
+    # If instance is changing groups, update both groups once the transaction
+    # commits
+    if previous_group_pk != next_group_pk:
+        maintenance.mark_group(previous_group_pk)
+        maintenance.mark_group(next_group_pk)
 
-    # If instance was not in a group before but will be, update that group
-    if next_group and next_group != previous_group:
-        next_group.add(instance)
 
-
-@receiver(post_delete, sender=BaseLot)
 def delete_lot_update_group(sender, instance=None, **kwargs):
     """Update the group this lot was part of to show that it was deleted."""
-    if instance.group:
-        instance.group.update()
+    maintenance.mark_group(instance.group_id)
+
+
+@receiver(post_save, sender=Use)
+def save_use_update_lot_visibility(sender, instance=None, created=False,
+                                   **kwargs):
+    """Update the visibility of lots with this use if its visibility changed."""
+    invalidate_on_commit('uses')
+    if created or getattr(instance, '_loaded_visible', None) == instance.visible:
+        return
+    lot_model = get_lot_model()
+    lot_model.objects.update_visibility(
+        lot_model.objects.filter(known_use=instance),
+    )
+    instance._loaded_visible = instance.visible
+
+
+@receiver(pre_delete, sender=Use)
+def delete_use_record_lots(sender, instance=None, **kwargs):
+    """Record the lots with this use before their known_use is cleared."""
+    instance._affected_lot_pks = list(get_lot_model().objects.filter(
+        known_use=instance,
+    ).values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Use)
+def delete_use_update_lot_visibility(sender, instance=None, **kwargs):
+    """Update the visibility of lots that had this use."""
+    invalidate_on_commit('uses')
+    lot_pks = getattr(instance, '_affected_lot_pks', None)
+    if lot_pks:
+        lot_model = get_lot_model()
+        lot_model.objects.update_visibility(
+            lot_model.objects.filter(pk__in=lot_pks),
+        )
+
+
+@receiver(post_save, sender=Boundary)
+def save_boundary_update_lots(sender, instance=None, **kwargs):
+    """Update the lots within this boundary."""
+    invalidate_on_commit('boundaries')
+    if boundary_index_enabled():
+        maintenance.mark_boundary(instance.pk)
+
+
+@receiver(post_delete, sender=Boundary)
+def delete_boundary_invalidate(sender, instance=None, **kwargs):
+    """Invalidate responses counting lots in this boundary."""
+    invalidate_on_commit('boundaries')
+
+
+def invalidate_lot_responses(lots, using=None):
+    """
+    Invalidate cached responses that depend on the given lots, a queryset,
+    once the transaction commits. Use this when lots are changed with
+    update(), which does not send signals, after the update. Outside a
+    transaction responses are invalidated right away.
+    """
+    tags = set(['lots'])
+    for centroid in lots.filter(centroid__isnull=False).values_list('centroid', flat=True):
+        tags.update(get_cell_tags(centroid.extent))
+    invalidate_on_commit(*tags, using=using)
+
+
+def save_lot_invalidate_responses(sender, instance=None, using=None, **kwargs):
+    """Invalidate cached responses that depend on this lot or group."""
+    tags = set(['lots'])
+    if getattr(instance, 'centroid', None):
+        tags.update(get_cell_tags(instance.centroid.extent))
+    invalidate_on_commit(*tags, using=using)
+
+
+# The lot's relations to each kind of user content
+LOT_CONTENT_RELATIONS = ('files', 'notes', 'photos',)
+
+
+def get_lot_content_tag(lot_pk):
+    return 'lot_content:%s' % lot_pk
+
+
+def invalidate_lot_content(sender, instance=None, **kwargs):
+    """Invalidate the cached content feed of the lot this content is on."""
+    lot_model = get_lot_model()
+    if instance.content_type_id == ContentType.objects.get_for_model(lot_model).pk:
+        invalidate_on_commit(get_lot_content_tag(instance.object_id))
+
+
+def connect_model_receivers():
+    """
+    Connect receivers for the concrete lot and lot group models. Receivers
+    for the abstract models would never be called, so this is called once
+    the app registry is ready.
+    """
+    lot_model = get_lot_model()
+    label = lot_model._meta.label_lower
+    pre_save.connect(save_lot_update_group, sender=lot_model,
+                     dispatch_uid='livinglots_lots_update_group_save_%s' % label)
+    post_delete.connect(delete_lot_update_group, sender=lot_model,
+                        dispatch_uid='livinglots_lots_update_group_delete_%s' % label)
+
+    for model in (get_lot_model(), get_lotgroup_model()):
+        if not model:
+            continue
+        label = model._meta.label_lower
+        post_save.connect(save_lot_invalidate_responses, sender=model,
+                          dispatch_uid='livinglots_lots_invalidate_save_%s' % label)
+        post_delete.connect(save_lot_invalidate_responses, sender=model,
+                            dispatch_uid='livinglots_lots_invalidate_delete_%s' % label)
+
+    # Invalidate lots' content feeds when their files, notes and photos change
+    for relation in LOT_CONTENT_RELATIONS:
+        try:
+            content_model = get_lot_model()._meta.get_field(relation).related_model
+        except FieldDoesNotExist:
+            continue
+        post_save.connect(invalidate_lot_content, sender=content_model,
+                          dispatch_uid='livinglots_lots_content_save_%s' % relation)
+        post_delete.connect(invalidate_lot_content, sender=content_model,
+                            dispatch_uid='livinglots_lots_content_delete_%s' % relation)
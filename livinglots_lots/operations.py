@@ -0,0 +1,97 @@
+"""
+Migration operations for deployments' concrete lot models.
+
+These add indexes that Django's model Meta cannot express. Use them in a
+migration of the app that defines the lot model, eg:
+
+    operations = [
+        AddVisibleLotIndexes('Lot'),
+        AddNamePrefixIndex('Lot'),
+    ]
+
+"""
+from django.db.migrations.operations.base import Operation
+
+
+class AddVisibleLotIndexes(Operation):
+    """
+    Add spatial indexes over only the lots that are publicly visible, so that
+    public map queries can be answered with a single-table index scan.
+    """
+    reduces_to_sql = True
+    reversible = True
+
+    fields = ('centroid', 'polygon',)
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def _get_index_name(self, model, field_name):
+        return '%s_visible_%s_gist' % (model._meta.db_table, field_name)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        qn = schema_editor.quote_name
+        for field_name in self.fields:
+            schema_editor.execute(
+                'CREATE INDEX %s ON %s USING GIST (%s) WHERE %s AND %s IS NULL' % (
+                    qn(self._get_index_name(model, field_name)),
+                    qn(model._meta.db_table),
+                    qn(model._meta.get_field(field_name).column),
+                    qn(model._meta.get_field('is_visible').column),
+                    qn(model._meta.get_field('group').column),
+                )
+            )
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        for field_name in self.fields:
+            schema_editor.execute('DROP INDEX IF EXISTS %s' % (
+                schema_editor.quote_name(self._get_index_name(model, field_name)),
+            ))
+
+    def describe(self):
+        return 'Add spatial indexes over visible %s' % self.model_name
+
+
+class AddNamePrefixIndex(Operation):
+    """
+    Add an index for case-insensitive prefix searches (name__istartswith) on
+    a model's name, as used when autocompleting lots and lot groups.
+    """
+    reduces_to_sql = True
+    reversible = True
+
+    def __init__(self, model_name, field_name='name'):
+        self.model_name = model_name
+        self.field_name = field_name
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def _get_index_name(self, model):
+        return '%s_%s_upper_prefix' % (model._meta.db_table, self.field_name)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        qn = schema_editor.quote_name
+        # Matches the UPPER(...::text) LIKE UPPER(...) that istartswith uses
+        schema_editor.execute(
+            'CREATE INDEX %s ON %s (UPPER(%s::text) text_pattern_ops)' % (
+                qn(self._get_index_name(model)),
+                qn(model._meta.db_table),
+                qn(model._meta.get_field(self.field_name).column),
+            )
+        )
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        schema_editor.execute('DROP INDEX IF EXISTS %s' % (
+            schema_editor.quote_name(self._get_index_name(model)),
+        ))
+
+    def describe(self):
+        return 'Add a name prefix index to %s' % self.model_name
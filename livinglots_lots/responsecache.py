@@ -0,0 +1,467 @@
+"""
+Caching responses of the map's GeoJSON, tile and count endpoints.
+
+Responses are keyed on the view, its canonicalized filters, the user's
+permission tier and the current versions of the cache tags the view depends
+on. Invalidating a tag (eg, when lots, layers or uses are saved) bumps its
+version so entries keyed on the old version are no longer found.
+
+The backend is chosen with LIVINGLOTS_LOTS_RESPONSE_CACHE_BACKEND: 'locmem'
+(the default), 'file', 'django' or the dotted path to a backend class, and
+configured with LIVINGLOTS_LOTS_RESPONSE_CACHE_OPTIONS. Entries expire after
+LIVINGLOTS_LOTS_RESPONSE_CACHE_TIMEOUT seconds.
+
+Tag versions are random tokens kept in the Django cache named by
+LIVINGLOTS_LOTS_RESPONSE_CACHE_TAGS_CACHE. It must be shared by every process
+that changes lots, so responses are not cached if it is a local memory or
+dummy cache, unless LIVINGLOTS_LOTS_RESPONSE_CACHE_LOCAL_TAGS is True (eg, for
+a single process in development).
+
+Responses about an area depend on the tags of the grid cells the area
+overlaps (see get_cell_tags()), which are invalidated when lots in them
+change.
+
+ConditionalResponseMixin uses the same key as an ETag to answer conditional
+GETs.
+
+"""
+from collections import OrderedDict
+import hashlib
+import logging
+from math import floor
+import os
+import tempfile
+import threading
+from time import time
+from uuid import uuid4
+
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Count, Max
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.module_loading import import_string
+from django.utils.six.moves import cPickle as pickle
+
+from .conf import get_setting
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_timeout():
+    return get_setting('RESPONSE_CACHE_TIMEOUT', 600)
+
+
+#
+# Backends
+#
+
+class LocMemBackend(object):
+    """An in-process cache that evicts the least recently used entries."""
+
+    def __init__(self, max_entries=500, timeout=None):
+        self.max_entries = max_entries
+        self.timeout = timeout or get_timeout()
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                expires, value = self.entries.pop(key)
+            except KeyError:
+                return None
+            if expires < time():
+                return None
+            self.entries[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time() + self.timeout, value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class FileBackend(object):
+    """A cache of files in a directory that evicts the oldest entries."""
+
+    def __init__(self, directory=None, max_entries=2000, timeout=None):
+        self.directory = directory or os.path.join(tempfile.gettempdir(),
+                                                   'livinglots_lots_cache')
+        self.max_entries = max_entries
+        self.timeout = timeout or get_timeout()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if os.path.getmtime(path) + self.timeout < time():
+                return None
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, key, value):
+        handle, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        paths = [self._path(name) for name in os.listdir(self.directory)
+                 if not name.endswith('.tmp')]
+        if len(paths) <= self.max_entries:
+            return
+        paths.sort(key=lambda path: os.path.getmtime(path))
+        for path in paths[:len(paths) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class DjangoCacheBackend(object):
+    """Use one of Django's configured caches."""
+
+    def __init__(self, alias='default', timeout=None):
+        self.cache = caches[alias]
+        self.timeout = timeout or get_timeout()
+
+    def get(self, key):
+        return self.cache.get('livinglots_lots:response:%s' % key)
+
+    def set(self, key, value):
+        self.cache.set('livinglots_lots:response:%s' % key, value, self.timeout)
+
+
+BACKENDS = {
+    'django': DjangoCacheBackend,
+    'file': FileBackend,
+    'locmem': LocMemBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            name = get_setting('RESPONSE_CACHE_BACKEND', 'locmem')
+            try:
+                backend_class = BACKENDS[name]
+            except KeyError:
+                backend_class = import_string(name)
+            _backend = backend_class(**get_setting('RESPONSE_CACHE_OPTIONS', {}))
+        return _backend
+
+
+#
+# Tags
+#
+
+def _get_tag_key(tag):
+    return 'livinglots_lots:response_cache_tag:%s' % tag
+
+
+def get_tag_cache():
+    return caches[get_setting('RESPONSE_CACHE_TAGS_CACHE', 'default')]
+
+
+_warned_tags_not_shared = False
+
+
+def tag_cache_is_shared():
+    """
+    Can invalidations made in one process be seen by the others? If not,
+    responses should not be cached.
+    """
+    global _warned_tags_not_shared
+    tag_cache = get_tag_cache()
+    if isinstance(tag_cache, DummyCache):
+        shared = False
+    elif isinstance(tag_cache, LocMemCache):
+        shared = get_setting('RESPONSE_CACHE_LOCAL_TAGS', False)
+    else:
+        shared = True
+    if not shared and not _warned_tags_not_shared:
+        logger.warning('Not caching responses, the cache tag versions are '
+                       'kept in a cache that is not shared between processes')
+        _warned_tags_not_shared = True
+    return shared
+
+
+def get_tag_versions(tags):
+    """
+    Get the current version of each of the given tags. Versions are random
+    so that a tag that was evicted never gets an old version back.
+    """
+    tag_cache = get_tag_cache()
+    keys = [_get_tag_key(tag) for tag in tags]
+    versions = tag_cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        for key in missing:
+            tag_cache.add(key, uuid4().hex, None)
+        versions.update(tag_cache.get_many(missing))
+    return [versions.get(key, '') for key in keys]
+
+
+def invalidate(*tags):
+    """Invalidate cached responses that depend on any of the given tags."""
+    get_tag_cache().set_many(dict(
+        (_get_tag_key(tag), uuid4().hex) for tag in tags
+    ), None)
+
+
+def get_cell_tags(extent):
+    """
+    Get the tags of the grid cells that the given extent, (xmin, ymin, xmax,
+    ymax), overlaps. Cells are LIVINGLOTS_LOTS_RESPONSE_CACHE_CELL_SIZE
+    degrees on a side.
+    """
+    size = get_setting('RESPONSE_CACHE_CELL_SIZE', .01)
+    xmin, ymin, xmax, ymax = [int(floor(c / size)) for c in extent]
+    return ['cell:%d:%d' % (x, y)
+            for x in range(xmin, xmax + 1)
+            for y in range(ymin, ymax + 1)]
+
+
+_local = threading.local()
+
+
+def _get_pending(using):
+    try:
+        pending = _local.pending
+    except AttributeError:
+        pending = _local.pending = {}
+    return pending.setdefault(using, set())
+
+
+def invalidate_on_commit(*tags, **kwargs):
+    """
+    Invalidate the given tags once the current transaction commits, once per
+    tag however many times this is called. Outside a transaction the tags are
+    invalidated right away, so call this after writing.
+    """
+    using = kwargs.get('using') or DEFAULT_DB_ALIAS
+    _get_pending(using).update(tags)
+    transaction.on_commit(lambda: flush(using), using=using)
+
+
+def flush(using=DEFAULT_DB_ALIAS):
+    pending = _get_pending(using)
+    tags = list(pending)
+    pending.clear()
+    if tags:
+        invalidate(*tags)
+
+
+#
+# Stats
+#
+
+class ResponseCacheStats(object):
+    """Hits, misses and response times per view, for this process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def record(self, view_name, hit, elapsed):
+        with self.lock:
+            stats = self.views.setdefault(view_name, {
+                'hits': 0,
+                'hit_time': 0.0,
+                'misses': 0,
+                'miss_time': 0.0,
+            })
+            if hit:
+                stats['hits'] += 1
+                stats['hit_time'] += elapsed
+            else:
+                stats['misses'] += 1
+                stats['miss_time'] += elapsed
+
+    def as_dict(self):
+        with self.lock:
+            summary = {}
+            for view_name, stats in self.views.items():
+                requests = stats['hits'] + stats['misses']
+                summary[view_name] = {
+                    'hits': stats['hits'],
+                    'misses': stats['misses'],
+                    'hit_rate': float(stats['hits']) / requests if requests else 0,
+                    'mean_hit_ms': (1000 * stats['hit_time'] / stats['hits']
+                                    if stats['hits'] else None),
+                    'mean_miss_ms': (1000 * stats['miss_time'] / stats['misses']
+                                     if stats['misses'] else None),
+                }
+            return summary
+
+
+stats = ResponseCacheStats()
+
+
+#
+# Views
+#
+
+def canonicalize_filters(query_dict, ignored=()):
+    """
+    Get a canonical string for the given QueryDict so that equivalent filters
+    in any order produce the same string.
+    """
+    params = []
+    for name, values in sorted(query_dict.lists()):
+        if name in ignored:
+            continue
+        values = sorted(v for v in values if v != '')
+        if values:
+            params.append('%s=%s' % (name, ','.join(values)))
+    return '&'.join(params)
+
+
+class ResponseKeyMixin(object):
+    """Identify a view's response by its filters and cache tag versions."""
+
+    # The cache tags this view's responses depend on
+    cache_tags = ('lots', 'layers', 'uses',)
+
+    # Query parameters that do not change the response
+    cache_ignored_params = ('_',)
+
+    def get_cache_tier(self):
+        if self.request.user.has_perm('lots.view_all_lots'):
+            return 'all'
+        return 'visible'
+
+    def get_response_key_parts(self):
+        return [
+            self.__class__.__name__,
+            self.get_cache_tier(),
+            canonicalize_filters(self.request.GET,
+                                 ignored=self.cache_ignored_params),
+            ','.join('%s=%s' % item for item in sorted(self.kwargs.items())),
+            ','.join(str(v) for v in get_tag_versions(self.cache_tags)),
+        ]
+
+
+class CachedResponseMixin(ResponseKeyMixin):
+    """Cache successful GET responses of a view."""
+
+    # The headers that are cached along with the content
+    cache_headers = ('Cache-Control', 'Content-Disposition',)
+
+    def get_cache_key(self):
+        key = '|'.join(self.get_response_key_parts())
+        return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method != 'GET' or not tag_cache_is_shared():
+            return super(CachedResponseMixin, self).dispatch(request, *args, **kwargs)
+        started = time()
+        backend = get_backend()
+        key = self.get_cache_key()
+
+        cached = backend.get(key)
+        if cached:
+            content, content_type, headers = cached
+            response = HttpResponse(content, content_type=content_type)
+            for header, value in headers:
+                response[header] = value
+            response['X-Cache'] = 'HIT'
+            stats.record(self.__class__.__name__, True, time() - started)
+            return response
+
+        response = super(CachedResponseMixin, self).dispatch(request, *args, **kwargs)
+        if response.status_code == 200:
+            if response.streaming:
+                response.streaming_content = self._cache_stream(backend, key, response)
+            else:
+                self._cache_response(backend, key, response, response.content)
+        response['X-Cache'] = 'MISS'
+        stats.record(self.__class__.__name__, False, time() - started)
+        return response
+
+    def _cache_response(self, backend, key, response, content):
+        if len(content) > get_setting('RESPONSE_CACHE_MAX_SIZE', 5 * 1024 * 1024):
+            return
+        headers = [(h, response[h]) for h in self.cache_headers if response.has_header(h)]
+        backend.set(key, (content, response['Content-Type'], headers))
+
+    def _cache_stream(self, backend, key, response):
+        """Stream the response, caching it once it has been sent if it fits."""
+        max_size = get_setting('RESPONSE_CACHE_MAX_SIZE', 5 * 1024 * 1024)
+        chunks, size = [], 0
+        for chunk in response.streaming_content:
+            yield chunk
+            if chunks is not None:
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > max_size:
+                    chunks = None
+        if chunks is not None:
+            self._cache_response(backend, key, response, b''.join(chunks))
+
+
+class ConditionalResponseMixin(ResponseKeyMixin):
+    """
+    Answer conditional GETs with 304 Not Modified when the lots a view would
+    return have not changed.
+
+    The ETag is the response's cache key: its filters, the permission tier
+    and the versions of the view's cache tags, so validating a request costs
+    no queries. If the tag versions are not shared between processes, the
+    filtered lots' count and most recent update are added with one aggregate
+    query.
+    """
+
+    def get_validator_queryset(self):
+        return self.get_lots().qs
+
+    def get_etag(self):
+        parts = self.get_response_key_parts()
+        if not tag_cache_is_shared():
+            aggregates = self.get_validator_queryset().aggregate(
+                count=Count('pk', distinct=True),
+                last_updated=Max('updated'),
+            )
+            last_updated = aggregates['last_updated']
+            parts += [
+                str(aggregates['count']),
+                last_updated.isoformat() if last_updated else '',
+            ]
+        return '"%s"' % hashlib.md5('|'.join(parts).encode('utf-8')).hexdigest()
+
+    def is_not_modified(self, etag):
+        if_none_match = self.request.META.get('HTTP_IF_NONE_MATCH')
+        if not if_none_match:
+            return False
+        etags = [e.strip() for e in if_none_match.split(',')]
+        etags = [e[2:] if e.startswith('W/') else e for e in etags]
+        return '*' in etags or etag in etags
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return super(ConditionalResponseMixin, self).dispatch(request, *args, **kwargs)
+        etag = self.get_etag()
+        if self.is_not_modified(etag):
+            response = HttpResponseNotModified()
+        else:
+            response = super(ConditionalResponseMixin, self).dispatch(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+        response['ETag'] = etag
+        return response
@@ -0,0 +1,156 @@
+"""
+Helpers for streaming large responses.
+
+"""
+import json
+import struct
+from time import localtime, time
+from xml.sax.saxutils import escape, quoteattr
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import six
+
+
+class Echo(object):
+    """A file-like object that returns what is written to it."""
+
+    def write(self, value):
+        return value
+
+
+def iter_values(qs, fields, chunk_size=2000):
+    """
+    Iterate over the values() of the given fields for the given queryset a
+    chunk at a time. Chunks are fetched by paging on pk, so only one chunk is
+    held in memory and the first rows are available right away.
+    """
+    fields = ['pk'] + [f for f in fields if f != 'pk']
+    qs = qs.order_by('pk').values(*fields)
+    last_pk = None
+    while True:
+        chunk = qs if last_pk is None else qs.filter(pk__gt=last_pk)
+        rows = list(chunk[:chunk_size])
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        last_pk = rows[-1]['pk']
+
+
+def iter_feature_collection(features, chunk_size=500):
+    """
+    Write a GeoJSON FeatureCollection incrementally.
+
+    features should yield (id, geometry, properties) where geometry is the
+    GeoJSON text of the feature's geometry, as produced by the database. It is
+    spliced into the output as-is rather than parsed and serialized again.
+    """
+    yield '{"type": "FeatureCollection", "features": ['
+    chunk = []
+    separator = ''
+    for (feature_id, geometry, properties) in features:
+        chunk.append('%s{"type": "Feature", "id": %s, "geometry": %s, "properties": %s}' % (
+            separator,
+            json.dumps(feature_id),
+            geometry or 'null',
+            json.dumps(properties, cls=DjangoJSONEncoder),
+        ))
+        separator = ', '
+        if len(chunk) >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+    yield ']}'
+
+
+def _kml_text(value):
+    if value is None:
+        return u''
+    return escape(six.text_type(value))
+
+
+def iter_kml_document(placemarks, name='', chunk_size=500):
+    """
+    Write a KML document incrementally, as UTF-8.
+
+    placemarks should yield (name, data, geometry) where data is a list of
+    (name, value) pairs for the placemark's ExtendedData and geometry is the
+    KML of the placemark's geometry, as produced by the database.
+    """
+    yield (u'<?xml version="1.0" encoding="UTF-8"?>\n'
+           u'<kml xmlns="http://www.opengis.net/kml/2.2"><Document>'
+           u'<name>%s</name>' % _kml_text(name)).encode('utf-8')
+    chunk = []
+    for (placemark_name, data, geometry) in placemarks:
+        chunk.append(u'<Placemark><name>%s</name><ExtendedData>%s</ExtendedData>%s</Placemark>' % (
+            _kml_text(placemark_name),
+            u''.join(u'<Data name=%s><value>%s</value></Data>' % (
+                quoteattr(data_name), _kml_text(value),
+            ) for data_name, value in data),
+            geometry or u'',
+        ))
+        if len(chunk) >= chunk_size:
+            yield u''.join(chunk).encode('utf-8')
+            chunk = []
+    if chunk:
+        yield u''.join(chunk).encode('utf-8')
+    yield b'</Document></kml>'
+
+
+def _dos_datetime(timestamp):
+    t = localtime(timestamp)
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+def iter_kmz(kml, chunk_size=64 * 1024):
+    """
+    Zip the given KML document, an iterable of UTF-8 chunks, as a KMZ.
+
+    The zip is written as the document is compressed: the entry's sizes and
+    checksum follow its data in a data descriptor, so the first bytes are
+    sent right away. The document must be smaller than 4 GB.
+    """
+    name = b'doc.kml'
+    dos_time, dos_date = _dos_datetime(time())
+    flags = 0x08    # Sizes and checksum are in the data descriptor
+    method = 8      # Deflated
+    version = 20
+
+    yield struct.pack('<IHHHHHIIIHH', 0x04034b50, version, flags, method,
+                      dos_time, dos_date, 0, 0, 0, len(name), 0) + name
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  -zlib.MAX_WBITS)
+    crc, size, compressed_size = 0, 0, 0
+    pending = []
+    pending_size = 0
+    for part in kml:
+        crc = zlib.crc32(part, crc)
+        size += len(part)
+        data = compressor.compress(part)
+        if data:
+            pending.append(data)
+            pending_size += len(data)
+        if pending_size >= chunk_size:
+            compressed_size += pending_size
+            yield b''.join(pending)
+            pending, pending_size = [], 0
+    pending.append(compressor.flush())
+    data = b''.join(pending)
+    compressed_size += len(data)
+    crc &= 0xffffffff
+    yield data + struct.pack('<IIII', 0x08074b50, crc, compressed_size, size)
+
+    local_header_size = 30 + len(name)
+    descriptor_size = 16
+    central_directory = struct.pack(
+        '<IHHHHHHIIIHHHHHII', 0x02014b50, version, version, flags, method,
+        dos_time, dos_date, crc, compressed_size, size, len(name), 0, 0, 0, 0,
+        0, 0,
+    ) + name
+    yield central_directory + struct.pack(
+        '<IHHHHIIH', 0x06054b50, 0, 0, 1, 1, len(central_directory),
+        local_header_size + compressed_size + descriptor_size, 0,
+    )
@@ -0,0 +1,109 @@
+"""
+Mapbox Vector Tiles of lots, generated by PostGIS (2.4 or later).
+
+"""
+from math import atan, degrees, pi, sinh
+
+from django.contrib.gis.geos import Polygon
+from django.db import connection
+from django.db.models import Case, CharField, Value, When
+
+# Half the width of the world in web mercator (EPSG:3857) meters
+WORLD_EXTENT = 20037508.342789244
+
+# The number of units across a tile, as in ST_AsMVT's default
+TILE_EXTENT = 4096
+
+
+def is_valid_tile(z, x, y, max_zoom=24):
+    """Is the given tile within the world, at a zoom no deeper than max_zoom?"""
+    return 0 <= z <= max_zoom and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def get_tile_bounds(z, x, y):
+    """Get the bounds of the given tile in web mercator."""
+    size = 2 * WORLD_EXTENT / 2 ** z
+    xmin = -WORLD_EXTENT + x * size
+    ymax = WORLD_EXTENT - y * size
+    return (xmin, ymax - size, xmin + size, ymax)
+
+
+def get_tile_polygon(z, x, y):
+    """Get the given tile as a polygon in WGS84 (EPSG:4326)."""
+    n = 2.0 ** z
+
+    def _lon(x):
+        return x / n * 360 - 180
+
+    def _lat(y):
+        return degrees(atan(sinh(pi * (1 - 2 * y / n))))
+
+    return Polygon.from_bbox((_lon(x), _lat(y + 1), _lon(x + 1), _lat(y)))
+
+
+def get_layer_expression():
+    """
+    An expression for the layer of a lot, as LotGeoJSONMixin.get_layer()
+    calculates it.
+    """
+    return Case(
+        When(known_use__isnull=False, then=Value('in use')),
+        When(owner__owner_type='public', then=Value('public')),
+        When(owner__owner_type='private', then=Value('private')),
+        default=Value(''),
+        output_field=CharField(),
+    )
+
+
+def render_tile_layer(lots, layer_name, geometry_field, z, x, y):
+    """
+    Render the given lots as one layer of a vector tile. Only lots whose
+    geometry's bounding box overlaps the tile are selected, using the spatial
+    index.
+    """
+    lots = lots.filter(**{
+        '%s__bboverlaps' % geometry_field: get_tile_polygon(z, x, y),
+    }).annotate(layer=get_layer_expression()).values(
+        'pk', 'layer', geometry_field,
+    ).distinct()
+    lots_sql, lots_params = lots.query.sql_with_params()
+
+    qn = connection.ops.quote_name
+    lot_model = lots.model
+    bounds = get_tile_bounds(z, x, y)
+
+    # Simplify to about a pixel at this zoom before clipping to the tile
+    tolerance = (bounds[2] - bounds[0]) / TILE_EXTENT
+
+    sql = ' '.join((
+        'SELECT ST_AsMVT(tile, %s, {extent}, \'geom\') FROM (',
+        '    SELECT lots.{pk} AS pk, lots.layer, ST_AsMVTGeom(',
+        '        ST_Simplify(ST_Transform(lots.{geom}, 3857), %s, true),',
+        '        ST_MakeEnvelope(%s, %s, %s, %s, 3857), {extent}, 64, true',
+        '    ) AS geom',
+        '    FROM ({lots_sql}) lots',
+        ') tile WHERE tile.geom IS NOT NULL',
+    )).format(
+        extent=TILE_EXTENT,
+        geom=qn(lot_model._meta.get_field(geometry_field).column),
+        lots_sql=lots_sql,
+        pk=qn(lot_model._meta.pk.column),
+    )
+    params = [layer_name, tolerance] + list(bounds) + list(lots_params)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+    if not row or row[0] is None:
+        return b''
+    return bytes(row[0])
+
+
+def render_tile(lots, z, x, y, min_polygon_zoom=15):
+    """
+    Render the given lots as a vector tile. Below min_polygon_zoom lots are
+    drawn as centroids in a 'centroids' layer, otherwise as polygons in a
+    'polygons' layer.
+    """
+    if z >= min_polygon_zoom:
+        return render_tile_layer(lots, 'polygons', 'polygon', z, x, y)
+    return render_tile_layer(lots, 'centroids', 'centroid', z, x, y)
@@ -8,7 +8,8 @@ from .views import (AddToGroupView, CheckLotWithParcelExistsView,
                     LotAutocomplete, LotContentJSON, LotDetailView,
                     LotGeoJSONDetailView, LotGroupAutocomplete, LotsGeoJSON,
                     LotsGeoJSONPolygon, LotsGeoJSONCentroid, LotsCountView,
-                    LotsCountBoundaryView, LotsCSV, LotsKML, RemoveFromGroupView)
+                    LotsCountBoundaryView, LotsCSV, LotsKML, LotsTileView,
+                    RemoveFromGroupView, ResponseCacheStatsView)
 
 
 urlpatterns = [
@@ -19,9 +20,13 @@ urlpatterns = [
         name='lot_geojson_polygon'),
     url(r'^geojson-centroid/', LotsGeoJSONCentroid.as_view(),
         name='lot_geojson_centroid'),
+    url(r'^tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.pbf$',
+        LotsTileView.as_view(), name='lot_tiles'),
     url(r'^count/', LotsCountView.as_view(), name='lot_count'),
     url(r'^count-by-boundary/', LotsCountBoundaryView.as_view(),
         name='lot_count_by_boundary'),
+    url(r'^cache-stats/', ResponseCacheStatsView.as_view(),
+        name='lot_cache_stats'),
 
     url(r'^(?P<pk>\d+)/$', LotDetailView.as_view(), name='lot_detail'),
     url(r'^(?P<pk>\d+)/geojson/$', LotGeoJSONDetailView.as_view(),
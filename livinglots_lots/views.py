@@ -1,13 +1,26 @@
+from calendar import timegm
+import csv
 from datetime import date
 import geojson
+import heapq
+from itertools import islice
 import json
 
 from django.contrib import messages
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.gis.db.models import GeometryField
+from django.contrib.gis.db.models.functions import AsGeoJSON, AsKML, Distance
+from django.contrib.gis.measure import D
+from django.core.exceptions import FieldDoesNotExist
 from django.core.urlresolvers import reverse
+from django.db.models import Q
+from django.db.models.functions import Coalesce
 from django.http import (Http404, HttpResponseRedirect, HttpResponse,
-                         HttpResponseBadRequest)
+                         HttpResponseBadRequest, StreamingHttpResponse)
 from django.shortcuts import get_object_or_404
+from django.utils import six
+from django.utils.cache import patch_cache_control
+from django.utils.dateparse import parse_datetime
 from django.utils.translation import ugettext_lazy as _
 from django.views.generic import FormView, TemplateView, View
 from django.views.generic.base import ContextMixin
@@ -17,17 +30,25 @@ from django.views.generic.edit import FormMixin
 from dal import autocomplete
 from braces.views import (CsrfExemptMixin, JSONResponseMixin, LoginRequiredMixin,
                           PermissionRequiredMixin)
-from inplace.boundaries.models import Boundary
-from inplace.views import (GeoJSONListView, GeoJSONResponseMixin, KMLView,
+from inplace.views import (GeoJSONListView, GeoJSONResponseMixin,
                            PlacesDetailView)
-from livinglots import get_lot_model, get_lotgroup_model
+from livinglots import get_lot_model, get_lotgroup_model, get_owner_model
 from livinglots_genericviews.views import CSVView, JSONResponseView
 from livinglots_organize.mail import mass_mail_organizers, mass_mail_watchers
 
+from .conf import get_setting
 from .exceptions import ParcelAlreadyInLot
+from .filters import boundary_counts, facet_counts
 from .forms import HideLotForm
-from .models import Use
+from .geometry import get_envelope, get_polygon_level
+from .responsecache import (CachedResponseMixin, ConditionalResponseMixin,
+                            get_cell_tags,
+                            stats as response_cache_stats)
+from .models import LOT_CONTENT_RELATIONS, Use, get_lot_content_tag
 from .signals import lot_details_loaded
+from .streaming import (Echo, iter_feature_collection, iter_kml_document,
+                        iter_kmz, iter_values)
+from .tiles import is_valid_tile, render_tile
 
 
 #
@@ -80,48 +101,215 @@ class LotAddGenericMixin(FormMixin):
         return initial
 
 
+def _get_column_value(obj, column):
+    """
+    Get the value that values() would return for the given column from an
+    object, following relations.
+    """
+    names = column.split('__')
+    for name in names[:-1]:
+        obj = getattr(obj, name)
+        if obj is None:
+            return None
+    try:
+        field = obj._meta.get_field(names[-1])
+    except (AttributeError, FieldDoesNotExist):
+        return getattr(obj, names[-1])
+    return getattr(obj, getattr(field, 'attname', names[-1]))
+
+
+def _column_getter(column, converter):
+    """Get a getter for a field exported from a column, for use on lots."""
+    def getter(self, lot):
+        value = _get_column_value(lot, column)
+        if converter:
+            value = converter(self, value)
+        return value
+    return getter
+
+
 class LotFieldsMixin(object):
     """
     A mixin that makes it easier to add a lot's fields to the view's output.
+
+    The view's fields are compiled once per view class into a plan of how to
+    get each field. Fields with a column (see columns) are read from rows of
+    values() and passed through convert_<field>(), if defined. Fields with
+    their own get_field_<field>() or that are properties of the lot are read
+    from lots, which are then loaded a chunk of rows at a time.
     """
+
+    # The values() columns that fields are exported from, where they are not
+    # columns on the lot itself
+    columns = {
+        'known_use': 'known_use__name',
+        'latitude': 'centroid',
+        'longitude': 'centroid',
+        'owner': 'owner__name',
+        'owner_type': 'owner__owner_type',
+    }
+
+    # Lots are loaded for fields that need them this many rows at a time
+    chunk_size = 500
+
     def get_fields(self):
         return self.fields
 
     def get_field_owner(self, lot):
+        if lot.owner is None:
+            return None
         return lot.owner.name
 
     def get_field_owner_type(self, lot):
+        if lot.owner is None:
+            return None
         return lot.owner.get_owner_type_display()
 
     def get_field_known_use(self, lot):
+        if lot.known_use is None:
+            return None
         return lot.known_use.name
 
-    def _field_value(self, lot, field):
+    def convert_latitude(self, centroid):
+        return centroid.y if centroid else None
+
+    def convert_longitude(self, centroid):
+        return centroid.x if centroid else None
+
+    def convert_owner_type(self, owner_type):
+        return self._get_owner_type_display(owner_type)
+
+    @classmethod
+    def _compile_field(cls, field):
+        """
+        Get (field, column, getter, converter) for the given field. column is
+        None if the field has to be read from lots with getter.
+        """
+        converter = getattr(cls, 'convert_%s' % field, None)
+        getter = getattr(cls, 'get_field_%s' % field, None)
+        if getter is not None:
+            default_getter = getattr(LotFieldsMixin, 'get_field_%s' % field, None)
+            overridden = (default_getter is None or
+                          six.get_unbound_function(getter) is not
+                          six.get_unbound_function(default_getter))
+            if not overridden and field in cls.columns:
+                return (field, cls.columns[field], getter, converter)
+            return (field, None, getter, None)
+
+        if field in cls.columns:
+            column = cls.columns[field]
+            return (field, column, _column_getter(column, converter), converter)
+
+        lot_model = get_lot_model()
         try:
-            # Call get_field_<field>()
-            return getattr(self, 'get_field_%s' % field)(lot)
-        except AttributeError:
-            try:
-                # Else try to get the property from the model instance
-                return getattr(lot, field)
-            except AttributeError:
-                return None
+            model_field = lot_model._meta.get_field(field)
+        except FieldDoesNotExist:
+            model_field = None
+        if model_field is not None and model_field.concrete and not model_field.is_relation:
+            return (field, field, _column_getter(field, converter), converter)
+        if model_field is not None or hasattr(lot_model, field):
+            return (field, None, lambda self, lot: getattr(lot, field), None)
+        return (field, None, lambda self, lot: None, None)
+
+    def get_field_plan(self):
+        """
+        Get a list of (field, column, getter, converter) for the view's
+        fields, compiling it the first time a view class uses the fields.
+        """
+        fields = tuple(self.get_fields())
+        cls = self.__class__
+        plans = cls.__dict__.get('_field_plans')
+        if plans is None:
+            plans = cls._field_plans = {}
+        try:
+            return plans[fields]
+        except KeyError:
+            plan = plans[fields] = [cls._compile_field(f) for f in fields]
+            return plan
 
     def _as_dict(self, lot):
-        return dict([(f, self._field_value(lot, f)) for f in self.get_fields()])
+        return dict((field, getter(self, lot)) for field, column, getter, converter
+                    in self.get_field_plan())
+
+    def get_columns(self):
+        """Get the values() columns needed to export the fields."""
+        return set(column for field, column, getter, converter
+                   in self.get_field_plan() if column)
+
+    def get_select_related(self):
+        """Get the relations to select when exporting the fields from lots."""
+        return set(column.rsplit('__', 1)[0] for column in self.get_columns()
+                   if '__' in column)
+
+    def _row_as_dict(self, row, lot=None):
+        """
+        Get the fields for a row of values() fetched with get_columns() and
+        the row's lot, if any fields are read from lots.
+        """
+        values = {}
+        for field, column, getter, converter in self.get_field_plan():
+            if column:
+                value = row[column]
+                if converter:
+                    value = converter(self, value)
+            else:
+                value = getter(self, lot) if lot is not None else None
+            values[field] = value
+        return values
+
+    def iter_field_rows(self, lots, extra_columns=()):
+        """
+        Iterate over (row, fields) for the given lots, a queryset, where row
+        holds the given extra values() columns.
+        """
+        columns = self.get_columns() | set(extra_columns)
+        needs_lots = any(column is None for field, column, getter, converter
+                         in self.get_field_plan())
+        rows = iter_values(lots, columns)
+        if not needs_lots:
+            for row in rows:
+                yield (row, self._row_as_dict(row))
+            return
+
+        lot_model = get_lot_model()
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                return
+            chunk_lots = lot_model.objects.select_related(
+                *self.get_select_related()
+            ).in_bulk([row['pk'] for row in chunk])
+            for row in chunk:
+                yield (row, self._row_as_dict(row, chunk_lots.get(row['pk'])))
+
+    def _get_owner_type_display(self, owner_type):
+        try:
+            owner_types = self._owner_types
+        except AttributeError:
+            owner_types = self._owner_types = dict(
+                get_owner_model()._meta.get_field('owner_type').flatchoices
+            )
+        return owner_types.get(owner_type, owner_type)
 
 
 class LotGeoJSONMixin(object):
+    geometry_field = 'polygon'
+    precision = 8
+
+    def get_layer(self, has_known_use, owner_type):
+        if has_known_use:
+            return 'in use'
+        elif owner_type == 'public':
+            return 'public'
+        elif owner_type == 'private':
+            return 'private'
+        return ''
 
     def get_feature(self, lot):
-        if lot.known_use:
-            layer = 'in use'
-        elif lot.owner and lot.owner.owner_type == 'public':
-            layer = 'public'
-        elif lot.owner and lot.owner.owner_type == 'private':
-            layer = 'private'
-        else:
-            layer = ''
+        layer = self.get_layer(
+            lot.known_use,
+            lot.owner.owner_type if lot.owner else None,
+        )
 
         try:
             lot_geojson = lot.geojson
@@ -139,6 +327,35 @@ class LotGeoJSONMixin(object):
             },
         )
 
+    def get_geometry(self):
+        """Get the geometry field (or expression) and precision to output."""
+        return (self.geometry_field, self.precision)
+
+    def get_feature_rows(self, lots):
+        """
+        Get (id, geometry, properties) for each of the given lots, with
+        geometries as GeoJSON text straight from the database.
+        """
+        geometry, precision = self.get_geometry()
+        lots = lots.annotate(geometry_geojson=AsGeoJSON(
+            geometry,
+            precision=precision,
+        ))
+        columns = ('geometry_geojson', 'known_use', 'owner__owner_type',)
+        for row in iter_values(lots, columns):
+            yield (row['pk'], row['geometry_geojson'], {
+                'pk': row['pk'],
+                'layer': self.get_layer(row['known_use'],
+                                        row['owner__owner_type']),
+            })
+
+    def render_feature_collection(self, lots):
+        """Stream a FeatureCollection of the given lots."""
+        return StreamingHttpResponse(
+            iter_feature_collection(self.get_feature_rows(lots)),
+            content_type='application/json',
+        )
+
 
 #
 # Export views
@@ -157,32 +374,103 @@ class ExportMixin(object):
         )
 
 
-class LotsCSV(ExportMixin, LotFieldsMixin, FilteredLotsMixin, CSVView):
+class LotsCSV(ConditionalResponseMixin, ExportMixin, LotFieldsMixin,
+              FilteredLotsMixin, CSVView):
     fields = ('address_line1', 'city', 'state_province', 'postal_code',
               'latitude', 'longitude', 'known_use', 'owner', 'owner_type',)
 
     def get_rows(self):
-        for lot in self.get_lots().qs.distinct():
-            yield self._as_dict(lot)
+        for row, values in self.iter_field_rows(self.get_lots().qs.distinct()):
+            yield values
+
+    def _encode(self, value):
+        if value is None:
+            return ''
+        if isinstance(value, six.text_type):
+            return value.encode('utf-8')
+        return value
+
+    def _get_header(self, field):
+        get_header_name = getattr(self, 'get_header_name', None)
+        if get_header_name:
+            return get_header_name(field)
+        return field
+
+    def iter_csv(self):
+        writer = csv.writer(Echo())
+        fields = self.get_fields()
+        yield writer.writerow([self._encode(self._get_header(f)) for f in fields])
+        for row in self.get_rows():
+            yield writer.writerow([self._encode(row.get(f)) for f in fields])
+
+    def _overrides_csvview(self):
+        """
+        Does a subclass override how CSVView renders? If so, let CSVView render
+        rather than streaming.
+        """
+        for name in ('render_to_response', 'write_csv', 'write_rows',):
+            base = getattr(CSVView, name, None)
+            if base is None:
+                continue
+            method = getattr(self.__class__, name)
+            if six.get_unbound_function(method) is not six.get_unbound_function(base):
+                return True
+        return False
+
+    def get(self, request, *args, **kwargs):
+        if self._overrides_csvview():
+            return super(LotsCSV, self).get(request, *args, **kwargs)
+        response = StreamingHttpResponse(self.iter_csv(),
+                                         content_type='text/csv')
+        response['Content-Disposition'] = ('attachment; filename="%s.csv"' %
+                                           self.get_filename())
+        return response
 
 
-class LotsKML(ExportMixin, LotFieldsMixin, FilteredLotsMixin, KMLView):
+class LotsKML(ConditionalResponseMixin, ExportMixin, LotFieldsMixin,
+              FilteredLotsMixin, View):
+    """
+    Stream the filtered lots as KML, or as KMZ if the format parameter is
+    'kmz'.
+    """
     fields = ('address_line1', 'city', 'state_province', 'postal_code',
               'known_use', 'owner', 'owner_type',)
+    geometry_field = 'centroid'
+    name_field = 'address_line1'
 
-    def get_context_data(self, **kwargs):
-        return {
-            'places': self.get_lots().qs.kml(),
-            'download': True,
-            'filename': self.get_filename(),
-        }
+    def get_placemarks(self):
+        lots = self.get_lots().qs.distinct().annotate(
+            geometry_kml=AsKML(self.geometry_field),
+        )
+        fields = self.get_fields()
+        for row, values in self.iter_field_rows(lots, ['geometry_kml']):
+            yield (
+                values.get(self.name_field),
+                [(f, values[f]) for f in fields],
+                row['geometry_kml'],
+            )
 
-    def render_to_response(self, context):
-        return super(LotsKML, self).render_to_response(context)
+    def get(self, request, *args, **kwargs):
+        kml = iter_kml_document(self.get_placemarks(), name=self.get_filename())
+        if request.GET.get('format') == 'kmz':
+            response = StreamingHttpResponse(
+                iter_kmz(kml),
+                content_type='application/vnd.google-earth.kmz',
+            )
+            extension = 'kmz'
+        else:
+            response = StreamingHttpResponse(
+                kml,
+                content_type='application/vnd.google-earth.kml+xml',
+            )
+            extension = 'kml'
+        response['Content-Disposition'] = ('attachment; filename="%s.%s"' %
+                                           (self.get_filename(), extension))
+        return response
 
 
-class LotsGeoJSON(ExportMixin, LotFieldsMixin, FilteredLotsMixin,
-                  GeoJSONResponseMixin, JSONResponseView):
+class LotsGeoJSON(ConditionalResponseMixin, ExportMixin, LotFieldsMixin,
+                  FilteredLotsMixin, GeoJSONResponseMixin, JSONResponseView):
     fields = ('address_line1', 'city', 'state_province', 'postal_code',
               'known_use', 'owner', 'owner_type',)
 
@@ -197,54 +485,103 @@ class LotsGeoJSON(ExportMixin, LotFieldsMixin, FilteredLotsMixin,
         )
 
     def get_queryset(self):
-        return self.get_lots()
+        return self.get_lots().qs.select_related(*self.get_select_related())
+
+    def get_feature_rows(self):
+        lots = self.get_lots().qs.distinct().annotate(
+            centroid_geojson=AsGeoJSON('centroid'),
+        )
+        for row, values in self.iter_field_rows(lots, ['centroid_geojson']):
+            yield (row['pk'], row['centroid_geojson'], values)
 
-    def render_to_response(self, context):
-        response = super(LotsGeoJSON, self).render_to_response(context)
+    def get(self, request, *args, **kwargs):
+        response = StreamingHttpResponse(
+            iter_feature_collection(self.get_feature_rows()),
+            content_type='application/json',
+        )
         if self.request.GET.get('download', 'no') == 'yes':
             response['Content-Disposition'] = ('attachment; filename="%s.json"' %
                                                self.get_filename())
         return response
 
 
-class LotsGeoJSONPolygon(LotGeoJSONMixin, FilteredLotsMixin, GeoJSONListView):
+class LotsGeoJSONPolygon(ConditionalResponseMixin, CachedResponseMixin,
+                         LotGeoJSONMixin, FilteredLotsMixin, GeoJSONListView):
+    geometry_field = 'polygon'
+
+    def get_geometry(self):
+        """Use the simplified polygon that suits the requested zoom."""
+        field_name, precision = get_polygon_level(self.request.GET.get('zoom'))
+        if field_name == 'polygon':
+            return (field_name, precision)
+        return (Coalesce(field_name, 'polygon'), precision)
 
     def get_queryset(self):
-        return self.get_lots().qs.filter(polygon__isnull=False).geojson(
-            field_name='polygon',
-            precision=8,
-        ).select_related('known_use', 'owner__owner_type')
+        return self.get_lots().qs.filter(polygon__isnull=False)
 
+    def get(self, request, *args, **kwargs):
+        return self.render_feature_collection(self.get_queryset())
 
-class LotsGeoJSONCentroid(LotGeoJSONMixin, FilteredLotsMixin, GeoJSONListView):
+
+class LotsGeoJSONCentroid(ConditionalResponseMixin, CachedResponseMixin,
+                          LotGeoJSONMixin, FilteredLotsMixin, GeoJSONListView):
+    geometry_field = 'centroid'
 
     def get_queryset(self):
-        return self.get_lots().qs.filter(centroid__isnull=False).geojson(
-            field_name='centroid',
-            precision=8,
-        ).select_related('known_use', 'owner__owner_type')
+        return self.get_lots().qs.filter(centroid__isnull=False)
+
+    def get(self, request, *args, **kwargs):
+        return self.render_feature_collection(self.get_queryset())
+
+
+class LotsTileView(ConditionalResponseMixin, CachedResponseMixin,
+                   FilteredLotsMixin, View):
+    """
+    Mapbox Vector Tiles of the lots matching the same filters as the GeoJSON
+    views. Browsers may cache tiles for LIVINGLOTS_LOTS_TILES_CACHE_TIMEOUT
+    seconds.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        z, x, y = int(kwargs['z']), int(kwargs['x']), int(kwargs['y'])
+        if not is_valid_tile(z, x, y, max_zoom=get_setting('TILES_MAX_ZOOM', 24)):
+            raise Http404
+        return super(LotsTileView, self).dispatch(request, *args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        z, x, y = int(kwargs['z']), int(kwargs['x']), int(kwargs['y'])
+        tile = render_tile(
+            self.get_lots().qs, z, x, y,
+            min_polygon_zoom=get_setting('TILES_MIN_POLYGON_ZOOM', 15),
+        )
+        response = HttpResponse(tile, content_type='application/x-protobuf')
+        patch_cache_control(response,
+                            max_age=get_setting('TILES_CACHE_TIMEOUT', 300),
+                            private=request.user.is_authenticated())
+        return response
 
 
 #
 # Counting views
 #
 
-class LotsCountView(FilteredLotsMixin, JSONResponseView):
+class LotsCountView(ConditionalResponseMixin, CachedResponseMixin,
+                    FilteredLotsMixin, JSONResponseView):
 
-    def get_context_data(self, **kwargs):
-        lots = self.get_lots()
-        context = {
-            'lots-count': lots.count(),
-            'no-known-use-count': lots.qs.filter(known_use__isnull=True).count(),
-            'in-use-count': lots.qs.filter(
-                known_use__isnull=False,
-                known_use__visible=True,
-            ).count(),
+    def get_count_facets(self):
+        """The counts to return, Q objects on the filtered lots by name."""
+        return {
+            'lots-count': None,
+            'no-known-use-count': Q(known_use__isnull=True),
+            'in-use-count': Q(known_use__in=Use.objects.filter(visible=True)),
         }
-        return context
+
+    def get_context_data(self, **kwargs):
+        return facet_counts(self.get_lots().qs, **self.get_count_facets())
 
 
-class LotsCountBoundaryView(JSONResponseView):
+class LotsCountBoundaryView(CachedResponseMixin, JSONResponseView):
+    cache_tags = ('boundaries', 'lots', 'layers', 'uses',)
 
     def get_context_data(self, **kwargs):
         return self.get_counts()
@@ -254,19 +591,26 @@ class LotsCountBoundaryView(JSONResponseView):
                                             user=self.request.user)
 
     def get_counts(self):
-        boundary_layer = self.request.GET.get('choropleth_boundary_layer', '')
-        lots = self.get_filters()
+        """
+        Get lot counts by boundary label. If more than one boundary layer is
+        requested, get them by boundary label by layer name.
+        """
+        layer_names = [name for name in
+                       self.request.GET.getlist('choropleth_boundary_layer')
+                       if name]
+        counts = boundary_counts(self.get_filters().qs, layer_names)
+        if len(layer_names) == 1:
+            return counts.get(layer_names[0], {})
+        return counts
 
-        boundaries = Boundary.objects.filter(
-            layer__name=boundary_layer,
-        )
 
-        counts = {}
-        for boundary in boundaries:
-            counts[boundary.label] = lots.filter(
-                centroid__within=boundary.simplified_geometry
-            ).count()
-        return counts
+class ResponseCacheStatsView(LoginRequiredMixin, PermissionRequiredMixin,
+                             JSONResponseView):
+    """Hit rates and response times of cached views, for this process."""
+    permission_required = 'lots.view_all_lots'
+
+    def get_context_data(self, **kwargs):
+        return response_cache_stats.as_dict()
 
 
 class LotsMap(TemplateView):
@@ -306,12 +650,79 @@ class LotDetailView(PlacesDetailView):
         return super(LotDetailView, self).get(request, *args, **kwargs)
 
 
-class LotGeoJSONDetailView(LotGeoJSONMixin, GeoJSONListView):
+class LotGeoJSONDetailView(CachedResponseMixin, LotGeoJSONMixin,
+                           GeoJSONListView):
+    """
+    A lot and the lots nearest it, up to LIVINGLOTS_LOTS_DETAIL_NEARBY_LIMIT
+    lots, with simplified polygons. Responses are cached until a lot in the
+    surrounding grid cells changes or polygons are simplified again.
+    """
     model = get_lot_model()
+    miles = .1
+    zoom = 16
+
+    def get_lot(self):
+        try:
+            return self._lot
+        except AttributeError:
+            lot = get_object_or_404(self.model, pk=self.kwargs['pk'])
+            if not (lot.is_visible or self.request.user.has_perm('lots.view_all_lots')):
+                raise Http404
+            self._lot = lot
+            return lot
+
+    def get_centroid(self):
+        """Get the lot's centroid without loading the rest of the lot."""
+        try:
+            return self._centroid
+        except AttributeError:
+            try:
+                self._centroid = self.model.objects.filter(
+                    pk=self.kwargs['pk'],
+                ).values_list('centroid', flat=True)[0]
+            except (IndexError, ValueError):
+                raise Http404
+            return self._centroid
+
+    def get_envelope(self):
+        return get_envelope(self.get_centroid(), self.miles)
+
+    def _get_cache_tags(self):
+        # Only the centroid is needed to look up a cached response, the lot
+        # itself is loaded on a miss
+        return (['geometry', 'uses', 'visibility'] +
+                get_cell_tags(self.get_envelope().extent))
+    cache_tags = property(_get_cache_tags)
+
+    def get_limit(self):
+        return get_setting('DETAIL_NEARBY_LIMIT', 25)
+
+    def get_geometry(self):
+        """Use simplified polygons, falling back on centroids."""
+        field_name, precision = get_polygon_level(self.zoom)
+        fields = ['polygon', 'centroid']
+        if field_name != 'polygon':
+            fields.insert(0, field_name)
+        return (Coalesce(*fields, output_field=GeometryField()), precision)
 
     def get_queryset(self):
-        lot = get_object_or_404(self.model, pk=self.kwargs['pk'])
-        return self.model.objects.find_nearby(lot, include_self=True, miles=.1)
+        lot = self.get_lot()
+        if self.request.user.has_perm('lots.view_all_lots'):
+            lots = self.model.objects.all()
+        else:
+            lots = self.model.objects.get_visible()
+        nearest = lots.filter(
+            # Prefilter with the centroid's spatial index before the more
+            # expensive distance test
+            centroid__bboverlaps=self.get_envelope(),
+            centroid__distance_lte=(lot.centroid, D(mi=self.miles)),
+        ).annotate(
+            distance=Distance('centroid', lot.centroid),
+        ).order_by('distance').values('pk')[:self.get_limit()]
+        return self.model.objects.filter(Q(pk=lot.pk) | Q(pk__in=nearest))
+
+    def get(self, request, *args, **kwargs):
+        return self.render_feature_collection(self.get_queryset())
 
 
 #
@@ -353,8 +764,17 @@ class BaseCreateLotView(PermissionRequiredMixin, View):
 
 class BaseCreateLotByGeomView(View):
 
+    def get_geojson_source(self, request):
+        """
+        Get the GeoJSON to create lots for. JSON request bodies are read as
+        they are parsed rather than loaded all at once.
+        """
+        if request.META.get('CONTENT_TYPE', '').startswith('application/json'):
+            return request
+        return request.POST.get('geom')
+
     def post(self, request, *args, **kwargs):
-        geom = request.POST.get('geom')
+        geom = self.get_geojson_source(request)
         lot = None
         lot_kwargs = {
             'added_reason': 'Drawn using add-lot mode',
@@ -364,9 +784,9 @@ class BaseCreateLotByGeomView(View):
 
         if geom:
             try:
-                lot = get_lot_model().objects.create_lot_for_geoms(geom, **lot_kwargs)
-            except ValueError:
-                return HttpResponseBadRequest('Only polygons are allowed')
+                lot = get_lot_model().objects.create_lots_for_geojson(geom, **lot_kwargs)
+            except ValueError as e:
+                return HttpResponseBadRequest(six.text_type(e))
 
         if lot:
             return HttpResponse('%s' % lot.pk, content_type='text/plain')
@@ -554,9 +974,76 @@ class EmailParticipantsView(LoginRequiredMixin, PermissionRequiredMixin,
         return self.render_json_response(context)
 
 
-class LotContentJSON(JSONResponseMixin, LotDetailView):
+class LotContentJSON(CachedResponseMixin, JSONResponseMixin, LotDetailView):
+    """
+    A lot's files, notes and photos, most recently added first, a page at a
+    time. Pass a page's next value as before to get the following page.
 
-    def get_files(self, lot):
+    The before cursor is the added time, type and id of the last item on the
+    previous page, so items added at the same time are not skipped.
+    """
+
+    # The lot's relations to each kind of user content
+    content_relations = LOT_CONTENT_RELATIONS
+
+    def _get_cache_tags(self):
+        # Saving the lot invalidates the cells it is in, so only this lot's
+        # changes invalidate its feed. Lots without a centroid fall back on
+        # every lot's changes.
+        centroid = self.model.objects.filter(
+            pk=self.kwargs['pk'],
+        ).values_list('centroid', flat=True).first()
+        tags = ['visibility', get_lot_content_tag(self.kwargs['pk'])]
+        if centroid:
+            return tags + get_cell_tags(centroid.extent)
+        return tags + ['lots']
+    cache_tags = property(_get_cache_tags)
+
+    def get_page_size(self):
+        return get_setting('CONTENT_PAGE_SIZE', 20)
+
+    def get_before(self):
+        """
+        Parse the before cursor into an (added, type, id) tuple. A bare
+        datetime is accepted and skips everything added at that time.
+        """
+        before = self.request.GET.get('before')
+        if not before:
+            return None
+        added, content_type, content_id = (before.split('|') + [None, None])[:3]
+        added = parse_datetime(added)
+        if not added:
+            return None
+        if content_type is None:
+            return (added, None, None)
+        try:
+            return (added, content_type, int(content_id))
+        except (TypeError, ValueError):
+            return None
+
+    def get_next(self, content):
+        return '%s|%s|%d' % (content['added'].isoformat(), content['type'],
+                             content['id'])
+
+    def _limit(self, qs, content_type, before, limit):
+        qs = qs.order_by('-added', '-pk')
+        if before:
+            added, before_type, before_id = before
+            # Items are ordered by (-added, type, -id), so at the cursor's
+            # added time only later types and, for the same type, lower ids
+            # come after it
+            after = Q(added__lt=added)
+            if before_type is not None:
+                if content_type > before_type:
+                    after |= Q(added=added)
+                elif content_type == before_type:
+                    after |= Q(added=added, pk__lt=before_id)
+            qs = qs.filter(after)
+        if limit is not None:
+            qs = qs[:limit]
+        return qs
+
+    def get_files(self, lot, before=None, limit=None):
         def _dict(file):
             return {
                 'added': file.added,
@@ -567,9 +1054,10 @@ class LotContentJSON(JSONResponseMixin, LotDetailView):
                 'type': 'file',
                 'url': self.request.build_absolute_uri(file.document.url),
             }
-        return [_dict(f) for f in lot.files.all()]
+        return [_dict(f) for f in self._limit(lot.files.all(), 'file', before,
+                                              limit)]
 
-    def get_notes(self, lot):
+    def get_notes(self, lot, before=None, limit=None):
         def _dict(note):
             return {
                 'added': note.added,
@@ -578,9 +1066,10 @@ class LotContentJSON(JSONResponseMixin, LotDetailView):
                 'text': note.text,
                 'type': 'note',
             }
-        return [_dict(n) for n in lot.notes.all()]
+        return [_dict(n) for n in self._limit(lot.notes.all(), 'note', before,
+                                              limit)]
 
-    def get_photos(self, lot):
+    def get_photos(self, lot, before=None, limit=None):
         def _dict(photo):
             return {
                 'added': photo.added,
@@ -591,19 +1080,45 @@ class LotContentJSON(JSONResponseMixin, LotDetailView):
                 'type': 'photo',
                 'url': self.request.build_absolute_uri(photo.thumbnail.url),
             }
-        return [_dict(p) for p in lot.photos.all()]
-
-    def get_usercontent(self, lot):
-        usercontent = self.get_files(lot) + self.get_notes(lot) + self.get_photos(lot)
-        usercontent = sorted(usercontent, key=lambda c: c['added'])
-        usercontent.reverse()
-        return usercontent
+        return [_dict(p) for p in self._limit(lot.photos.all(), 'photo', before,
+                                              limit)]
+
+    def get_usercontent(self, lot, before=None, limit=None):
+        """
+        Get up to limit items of the lot's user content after the given
+        (added, type, id) cursor, merging the most recent items of each kind.
+        """
+        def _sort_key(content):
+            added = content['added']
+            return (-(timegm(added.utctimetuple()) + added.microsecond / 1e6),
+                    content['type'], -content['id'])
+
+        streams = (
+            self.get_files(lot, before, limit),
+            self.get_notes(lot, before, limit),
+            self.get_photos(lot, before, limit),
+        )
+        merged = heapq.merge(*[[(_sort_key(c), c) for c in stream]
+                               for stream in streams])
+        return [content for key, content in islice(merged, limit)]
 
     def get(self, request, *args, **kwargs):
         lot = self.object = self.get_object()
+        before = self.get_before()
+        if before is None and request.GET.get('before'):
+            return HttpResponseBadRequest('Could not parse before')
+
+        page_size = self.get_page_size()
+        usercontent = self.get_usercontent(lot, before=before,
+                                           limit=page_size + 1)
+        next_before = None
+        if len(usercontent) > page_size:
+            usercontent = usercontent[:page_size]
+            next_before = self.get_next(usercontent[-1])
 
         context = {
-            'usercontent': self.get_usercontent(lot),
+            'next': next_before,
+            'usercontent': usercontent,
         }
 
         return self.render_json_response(context)
@@ -612,27 +1127,39 @@ class LotContentJSON(JSONResponseMixin, LotDetailView):
 #
 # Autocomplete
 #
-class LotAutocomplete(autocomplete.Select2QuerySetView):
+class NameAutocompleteMixin(object):
+    """
+    Autocomplete on the start of names, a page of results at a time in name
+    order. The name__istartswith lookup can use the index that
+    AddNamePrefixIndex adds.
+    """
+    paginate_by = 10
+
+    # The fields needed to label results
+    label_fields = ('name', 'address_line1',)
+
+    def get_model(self):
+        raise NotImplementedError('Implement NameAutocompleteMixin.get_model()')
+
     def get_queryset(self):
+        model = self.get_model()
         if not self.request.user.is_authenticated():
-            return get_lot_model().objects.none()
+            return model.objects.none()
 
-        qs = get_lot_model().objects.all()
+        qs = model.objects.only('pk', *self.label_fields)
         if self.q:
             qs = qs.filter(name__istartswith=self.q)
-        qs.order_by('name')
+        return qs.order_by('name', 'pk')
 
-        return qs
 
+class LotAutocomplete(NameAutocompleteMixin, autocomplete.Select2QuerySetView):
 
-class LotGroupAutocomplete(autocomplete.Select2QuerySetView):
-    def get_queryset(self):
-        if not self.request.user.is_authenticated():
-            return get_lotgroup_model().objects.none()
+    def get_model(self):
+        return get_lot_model()
 
-        qs = get_lotgroup_model().objects.all()
-        if self.q:
-            qs = qs.filter(name__istartswith=self.q)
-        qs.order_by('name')
 
-        return qs
+class LotGroupAutocomplete(NameAutocompleteMixin,
+                           autocomplete.Select2QuerySetView):
+
+    def get_model(self):
+        return get_lotgroup_model()